@@ -1,9 +1,12 @@
+import asyncio
 import random
 import re
 import os
+import traceback
 from io import BytesIO
 from discord import File
 from app.handlers.services import *
+from app.handlers import renderexecutor
 
 # ERRORS
 
@@ -16,6 +19,17 @@ class MalformedArgumentError(Error):
 	pass
 
 
+# MATCHING
+
+def spelled_out(word):
+	"""Return regex for lowercase word with anything but letters between its letters, and 0 or () for any o (e.g. 'p.0.j.()' for 'pojo')"""
+	letters = ['(?:[o0]|\\(\\))' if letter == 'o' else re.escape(letter) for letter in word]
+
+	# Between letters: anything but letters, 0's and ()'s (a paren on its own is fine)
+	separator = '(?:[^a-z0()]|\\((?!\\))|(?<!\\()\\))*'
+	return separator.join(letters)
+
+
 # CLASS
 
 class MessageHandler:
@@ -32,6 +46,13 @@ class MessageHandler:
 		func.command = True
 		return func
 
+	def triggers(*patterns):
+		"""Adds 'triggers' attribute: regexes (matched against the lowercased message) one of which must match for the filter to run"""
+		def decorator(func):
+			func.triggers = patterns
+			return func
+		return decorator
+
 	def secret(func):
 		"""Adds 'secret' attribute. Value irrelevant since only tested with hasattr()"""
 		func.secret = True
@@ -130,15 +151,44 @@ class MessageHandler:
 
 	@command
 	async def dice(self, message):
-		"""Let Pojo roll your D&D dice for you based on your provided equation. Format dice as multiplier + 'd' + number of sides (e.g., `1d20`). Supports addition and subtraction.
+		"""Let Pojo roll your D&D dice for you based on your provided equation. Format dice as multiplier + 'd' + number of sides (e.g., `1d20`). Supports addition and subtraction, keeping or dropping the highest or lowest rolls (`4d6kh3`, `2d20kl1`, `4d6dl1`, `4d6dh1`), and exploding dice that roll again on their top face (`1d6!`).
+
+		Usage: `))dice 1d20`, `))dice 3d10`, `))dice 2d20 - 1d6  + 10`, `))dice 4d6kh3`, `))dice 3d6!`, `))dice 1000000d6`, `))dice 1d20 + 5 x 10`
+		Returns: Total, individual rolls (if more than one; pools of 100+ dice get a summary and histogram instead)
+		Arguments: Equation to parse (see usage examples), optionally followed by `x N` or `repeat=N` to roll it N times at once
 
-		Usage: `))dice 1d20`, `))dice 3d10`, `))dice 2d20 - 1d6  + 10`
-		Returns: Total, individual rolls (if more than one)
-		Arguments: Equation to parse (see usage examples)
+		For odds instead of a roll, `))dice stats 4d6 - 1d4 + 3 >= 15` works out the exact distribution of the total (mean, variance, percentiles, and the chance of at least the number after `>=`, if given).
 		"""
-		service = diceservice.DiceService()
 		command, remainder = self.split_by_command(message)
-		response = service.process(remainder)
+
+		# Distribution report instead of a roll
+		if remainder is not None and remainder.split()[0] == 'stats':
+			await self.dice_stats(message, remainder[len('stats'):].strip())
+			return
+
+		# Huge pools are rolled in a worker so other messages aren't kept waiting
+		if diceservice.needs_worker(remainder):
+			try:
+				response = await self.render_executor.run(diceservice.process, remainder)
+			except (renderexecutor.QueueFullError, renderexecutor.RenderTimeoutError):
+				response = 'Pojo has too many dice in the air right now. Try again in a moment.'
+		else:
+			service = diceservice.DiceService()
+			response = service.process(remainder)
+
+		await message.channel.send(response)
+
+	async def dice_stats(self, message, arguments):
+		"""Send report for `))dice stats`, working out big distributions in a worker so they don't block other messages"""
+		if diceservice.stats_needs_worker(arguments):
+			try:
+				response = await self.render_executor.run(diceservice.stats_process, arguments)
+			except (renderexecutor.QueueFullError, renderexecutor.RenderTimeoutError):
+				response = 'Pojo is busy with a lot of math right now. Try again in a moment.'
+		else:
+			service = diceservice.DiceService()
+			response = service.stats_response(arguments)
+
 		await message.channel.send(response)
 
 	@rename('secret')
@@ -164,11 +214,37 @@ class MessageHandler:
 		Usage: `))iching` or `))iching What will happen if I drop CST-201?` or `))iching What should my attitude be toward learning MongoDB?`
 		Returns: Your I Ching casting
 		Arguments: None (or, your question, though not actually necessary)
+
+		For the curious, `))iching stats n=100000` casts `n` times at once and reports how often each line and hexagram came up.
 		"""
+		command, remainder = self.split_by_command(message)
+
+		# Distribution report instead of a reading
+		if remainder is not None and remainder.split()[0] == 'stats':
+			await self.i_ching_stats(message, remainder[len('stats'):].strip())
+			return
+
 		service = ichingservice.IChingService()
 		response = service.response()
 		await message.channel.send(response)
 
+	async def i_ching_stats(self, message, arguments):
+		"""Send report for `))iching stats`, casting in a worker so large n doesn't block other messages"""
+		try:
+			n = self.args_to_dict(arguments).get('n', 10000) if arguments != '' else 10000
+		except MalformedArgumentError:
+			n = None
+
+		if not isinstance(n, int) or isinstance(n, bool) or not 1 <= n <= ichingservice.MAX_STATS_CASTINGS:
+			response = 'Use `))iching stats n=100000`, with `n` from 1 to {:,}.'.format(ichingservice.MAX_STATS_CASTINGS)
+		else:
+			try:
+				response = await self.render_executor.run(ichingservice.stats_report, n)
+			except (renderexecutor.QueueFullError, renderexecutor.RenderTimeoutError):
+				response = 'The yarrow stalks are busy. Try again in a moment.'
+
+		await message.channel.send(response)
+
 	@secret
 	@command
 	async def cat(self, message):
@@ -197,6 +273,7 @@ class MessageHandler:
 		 • `definitions`: Whether Pojo sends follow-up card definitions. Options: `true` [default], `false` (for pros)
 		 • `reversals`: Whether reading includes reversed/inverted cards. Options: `true`, `false` [default]
 		 • `pips`: Whether reading includes pips (standard numbered and face cards). Options `true` [default], `false`
+		 • `resolution`: Size of the cards in the image. Options: `full`, `preview`, `thumbnail` (default depends on spread: `preview` for `celtic-cross`, `full` otherwise)
 		"""
 		# Send "typing" because this one can take a few seconds
 		await message.channel.typing()
@@ -205,7 +282,6 @@ class MessageHandler:
 		command, remainder = self.split_by_command(message)
 		kwargs = {}
 
-		response = None
 		response_message = ""
 		response_image = None
 
@@ -217,28 +293,21 @@ class MessageHandler:
 			response_message = "Arguments could not be parsed. For formatting help, use `))help tarot`."
 			kwargs = None
 
-		# Attempt response
+		# Attempt response (rendered in a worker so big spreads don't block other messages)
 		if kwargs is not None:
-			service = tarotservice.TarotService()
 			try:
-				response = service.response(**kwargs)
+				response_message, response_image = await self.render_executor.run(tarotservice.render, kwargs, self.image_encoder)
 			except TypeError:
 				response_message = "Received an unexpected argument. For all allowed arguments, use `))help tarot`."
-
-			# Get message and image from response model
-			if response is not None:
-				response_message = response.message
-				response_image = response.image
+			except renderexecutor.QueueFullError:
+				response_message = "Pojo is shuffling too many decks right now. Try again in a moment."
+			except renderexecutor.RenderTimeoutError:
+				response_message = "Pojo took too long laying out your cards. Try again, maybe with a smaller spread."
 
 		# Send image (if received)
 		if response_image is not None:
-			# Convert to BytesIO file-like object (necessary to send through Discord.py's send())
-			bytes = BytesIO()
-			response_image.save(bytes, 'PNG')
-			bytes.name = 'tarot.png'
-			bytes.seek(0)
-
-			f = File(bytes, filename="tarot.png")
+			# Wrap in BytesIO file-like object (necessary to send through Discord.py's send())
+			f = File(BytesIO(response_image), filename="tarot." + self.image_encoder.extension)
 			await message.channel.send(file=f)
 
 		# Send response text (if any)
@@ -254,7 +323,38 @@ class MessageHandler:
 		Arguments: None
 		"""
 		service = factservice.FactService()
-		response = service.response(message.author.id)
+		response = await service.response(message.author.id)
+		await message.channel.send(response)
+
+	@secret
+	@command
+	async def metrics(self, message):
+		"""Debug method listing counters for Pojo's caches.
+
+		Usage: `))metrics`
+		Returns: Current cache sizes, hit/miss/eviction counts, render queue counters, fact backend breaker states and filter match rates
+		Arguments: None
+		"""
+		sections = {
+			'render executor': self.render_executor.stats(),
+			'iching data index': ichingservice.IChingService.data_index.stats(),
+			'dice distribution cache': diceservice.distribution_cache.stats(),
+			'fact redis breaker': factservice.FactService.redis_breaker.stats(),
+			'fact mysql breaker': factservice.FactService.db_breaker.stats(),
+			'handler errors': self.handler_errors,
+			'filter matches': self.filter_match_rates()
+		}
+
+		# Images are decoded and cached in the workers, so ask one of them (if one's free)
+		try:
+			worker_stats = await self.render_executor.run(tarotservice.cache_stats)
+			sections.update({name + ' (one worker)': stats for name, stats in worker_stats.items()})
+		except (renderexecutor.QueueFullError, renderexecutor.RenderTimeoutError):
+			sections['worker caches'] = {'status': 'render workers busy'}
+
+		response = '```'
+		response += '\n'.join(name + ': ' + ', '.join('{}={}'.format(k, v) for k, v in stats.items()) for name, stats in sections.items())
+		response += '```'
 		await message.channel.send(response)
 
 	@secret
@@ -402,68 +502,68 @@ class MessageHandler:
 	# GENERAL FILTERS
 
 	@general_filter
+	@triggers(spelled_out('pojo'), spelled_out('plainoldjavaobject'))
 	async def someone_say_pojo(self, message):
-		"""Responds with random message to variations of 'Pojo'."""
-		# Lowercase
-		msg = message.content.lower()
-
-		# Quick rejection if no p or j
-		if 'p' not in msg or 'j' not in msg:
-			return
+		"""Responds with random message to variations of 'Pojo' (like 'P0J0' or 'p.o.j.o')."""
+		responses = [
+			'Pojo?',
+			'Pooojooo',
+			'POJO!',
+			'...pojo',
+			'Pojopojopojopojo',
+			'POJO!!!!!',
+			'Pojo...',
+			'Pojo?',
+			'Someone say "Pojo?"',
+			'Pojo',
+			'Oh...pojo.',
+			'Pojo',
+			'Pojo...pojo.',
+			'Pojo? Pojo.',
+			'Poooooooojoooo',
+			'Po? Jo?',
+			'ＰＯＪＯ',
+			'Pojo! Pojo!!',
+			'𝖕𝖔𝖏𝖔',
+			'𝕡𝕠𝕛𝕠'
+		]
 
-		# Convert zeros to o's
-		msg = msg.replace('0', 'o')
-
-		# Convert ()'s to o's
-		msg = msg.replace('()', 'o')
-
-		# Remove non-alphabetic characters
-		msg = re.sub('[^a-z]+', '', msg)
-
-		# Keyword matches
-		pojos = ["pojo", "plainoldjavaobject"]
-
-		# If any of the pojo matches are in msg...
-		if any(pojo in msg for pojo in pojos):
-			responses = [
-				'Pojo?',
-				'Pooojooo',
-				'POJO!',
-				'...pojo',
-				'Pojopojopojopojo',
-				'POJO!!!!!',
-				'Pojo...',
-				'Pojo?',
-				'Someone say "Pojo?"',
-				'Pojo',
-				'Oh...pojo.',
-				'Pojo',
-				'Pojo...pojo.',
-				'Pojo? Pojo.',
-				'Poooooooojoooo',
-				'Po? Jo?',
-				'ＰＯＪＯ',
-				'Pojo! Pojo!!',
-				'𝖕𝖔𝖏𝖔',
-				'𝕡𝕠𝕛𝕠'
-			]
-
-			response = random.choice(responses)
-			await message.channel.send(response)
+		response = random.choice(responses)
+		await message.channel.send(response)
 
 	@general_filter
+	@triggers('greater good')
 	async def greater_good(self, message):
 		"""Respond to 'greater good' so I don't have to."""
-		# Lowercase
-		msg = message.content.lower()
-
-		# If 'greater good' is found, respond in kind
-		if 'greater good' in msg:
-			response = '*The greater good*'
-			await message.channel.send(response)
+		response = '*The greater good*'
+		await message.channel.send(response)
 
 	# TOOLS
 
+	def matched_filters(self, message):
+		"""Return list of filters with a trigger in message (scanning the lowercased message once)"""
+		self.messages_scanned += 1
+		if not self.triggered_filters:
+			return []
+
+		# Collect filter of each match, stopping early once every filter has matched
+		matched = set()
+		for match in self.trigger_regex.finditer(message.content.lower()):
+			matched.add(match.lastgroup)
+			if len(matched) == len(self.triggered_filters):
+				break
+
+		for name in matched:
+			self.filter_matches[name] += 1
+		return [self.triggered_filters[name] for name in matched]
+
+	def filter_match_rates(self):
+		"""Return dict of messages scanned and each filter's matches (with share of messages)"""
+		rates = {'messages': self.messages_scanned}
+		for name, count in self.filter_matches.items():
+			rates[name] = '{} ({:.2%})'.format(count, count / self.messages_scanned if self.messages_scanned else 0)
+		return rates
+
 	def split_by_command(self, message):
 		"""Return tuple of command (w/o prefix) and remainder of message. (Either may be None.)"""
 		prefix = '))'
@@ -528,22 +628,60 @@ class MessageHandler:
 	def __init__(self, client):
 		self.client = client
 
+		# Worker pool for CPU-heavy commands (e.g. tarot image rendering)
+		self.render_executor = renderexecutor.RenderExecutor()
+
+		# Output format for generated images (WebP/JPEG/PNG, chosen per deployment)
+		self.image_encoder = imageencoder.ImageEncoder()
+
 		# Get all methods in class
 		functions = [getattr(MessageHandler, func) for func in dir(MessageHandler)]
 
 		# Store list of methods with 'filter' attribute (from @general_filter)
 		self.filters = [func for func in functions if hasattr(func, 'filter')]
 
+		# Compile every filter's triggers (from @triggers) into one regex, a named group per filter, so a message is scanned once
+		self.triggered_filters = {func.__name__: func for func in self.filters if hasattr(func, 'triggers')}
+		self.trigger_regex = re.compile('|'.join('(?P<{}>{})'.format(name, '|'.join(func.triggers)) for name, func in self.triggered_filters.items()))
+
+		# Filters without triggers run on every message
+		self.untriggered_filters = [func for func in self.filters if not hasattr(func, 'triggers')]
+
+		# Messages scanned and matches per filter, for ))metrics
+		self.messages_scanned = 0
+		self.filter_matches = dict.fromkeys(self.triggered_filters, 0)
+
 		# Set up dict of commands with methods with 'command' attribute (from @command)
 		command_functions = [func for func in functions if hasattr(func, 'command')]
 		command_names = [c.__name__ for c in command_functions]
 		self.commands = dict(zip(command_names, command_functions))
 
-	async def parse(self, message):
-		# Run filters
-		for func in self.filters:
-			await func(self, message)
+		# Most filters/commands run at once for one message (0 for no limit)
+		self.handler_limit = int(os.environ.get('HANDLER_LIMIT', 0))
+
+		# Errors raised by each filter/command, for ))metrics
+		self.handler_errors = {}
+
+	async def run_handler(self, func, message, semaphore=None):
+		"""Run one filter or command, reporting its error instead of letting it affect the others"""
+		try:
+			if semaphore is None:
+				await func(self, message)
+			else:
+				async with semaphore:
+					await func(self, message)
+		except Exception:
+			self.handler_errors[func.__name__] = self.handler_errors.get(func.__name__, 0) + 1
+			traceback.print_exc()
 
+	async def parse(self, message):
+		# Matched command first, so it gets a slot first if handlers are limited
+		handlers = []
 		name, remainder = self.split_by_command(message)
 		if (name is not None and name in self.commands):
-			await self.commands[name](self, message)
+			handlers.append(self.commands[name])
+		handlers += self.untriggered_filters + self.matched_filters(message)
+
+		# Run command and filters together, so a slow filter doesn't hold up the reply
+		semaphore = asyncio.Semaphore(self.handler_limit) if self.handler_limit > 0 else None
+		await asyncio.gather(*[self.run_handler(func, message, semaphore) for func in handlers])
@@ -0,0 +1,127 @@
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# ERRORS
+
+class Error(Exception):
+	"""Generic error to extend"""
+	pass
+
+class QueueFullError(Error):
+	"""Every worker is busy and the waiting queue is full."""
+	pass
+
+class RenderTimeoutError(Error):
+	"""The job didn't finish within the executor's timeout."""
+	pass
+
+
+# CLASS
+
+class RenderExecutor:
+	"""Runs CPU-heavy jobs (image decoding, compositing, encoding) in a worker pool so the event loop keeps serving other messages.
+
+	Settings come from arguments or environment variables:
+	 • `RENDER_EXECUTOR`: `process` [default] or `thread`
+	 • `RENDER_WORKERS`: Number of workers (default 2)
+	 • `RENDER_QUEUE_SIZE`: Jobs allowed to wait for a free worker before new ones are rejected (default 8)
+	 • `RENDER_TIMEOUT`: Seconds to wait for a job before giving up on it (default 30)
+
+	Jobs must be module-level functions with picklable arguments and results so they can run in a process pool.
+	"""
+	def __init__(self, kind=None, workers=None, queue_size=None, timeout=None):
+		self.kind = kind or os.environ.get('RENDER_EXECUTOR', 'process')
+		self.workers = workers or int(os.environ.get('RENDER_WORKERS', 2))
+		self.queue_size = queue_size if queue_size is not None else int(os.environ.get('RENDER_QUEUE_SIZE', 8))
+		self.timeout = timeout or float(os.environ.get('RENDER_TIMEOUT', 30))
+
+		if self.kind not in ('process', 'thread'):
+			raise ValueError("RENDER_EXECUTOR must be 'process' or 'thread'")
+
+		# Pool is created by start() or on first job so importing/constructing is cheap
+		self.pool = None
+
+		# Jobs running or waiting for a worker (only touched from the event loop thread)
+		self.pending = 0
+
+		# Counters for monitoring
+		self.completed = 0
+		self.rejected = 0
+		self.timeouts = 0
+
+	def start(self):
+		"""Create worker pool and start its workers now. Call before any other threads start (i.e. before the client runs), so forked workers can't inherit a lock another thread held."""
+		if self.pool is None and self.kind == 'process':
+			# Default context (fork on Linux), so workers inherit anything decoded up front
+			self.pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context())
+
+			# Workers are launched with the first job
+			self.pool.submit(int).result()
+
+		return self.get_pool()
+
+	def get_pool(self):
+		"""Create worker pool if needed and return it"""
+		if self.pool is None:
+			if self.kind == 'process':
+				# Other threads are running by now (discord.py's, asyncio.to_thread's), so don't fork:
+				# start workers from a clean server process (or fresh interpreters where there's no forkserver)
+				method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+				self.pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context(method))
+			else:
+				self.pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='render')
+		return self.pool
+
+	def release(self, future):
+		"""Free a queue slot once a job is really done (not just abandoned by a timeout)"""
+		self.pending -= 1
+		if not future.cancelled() and future.exception() is None:
+			self.completed += 1
+
+	async def run(self, func, *args):
+		"""Run func(*args) in the pool and return its result. Raises QueueFullError or RenderTimeoutError."""
+		if self.pending >= self.workers + self.queue_size:
+			self.rejected += 1
+			raise QueueFullError()
+
+		loop = asyncio.get_running_loop()
+
+		try:
+			job = self.get_pool().submit(func, *args)
+		except BrokenProcessPool:
+			# A worker died (e.g. killed for memory). Start a fresh pool next time.
+			self.pool = None
+			raise
+
+		# Slot stays taken until the worker finishes, even if we stop waiting on it
+		self.pending += 1
+		job.add_done_callback(lambda f: loop.call_soon_threadsafe(self.release, f))
+
+		try:
+			return await asyncio.wait_for(asyncio.wrap_future(job), self.timeout)
+		except asyncio.TimeoutError:
+			self.timeouts += 1
+			raise RenderTimeoutError()
+		except BrokenProcessPool:
+			self.pool = None
+			raise
+
+	def stats(self):
+		"""Return dict of settings and counters for monitoring"""
+		return {
+			'kind': self.kind,
+			'workers': self.workers,
+			'pending': self.pending,
+			'completed': self.completed,
+			'rejected': self.rejected,
+			'timeouts': self.timeouts
+		}
+
+	def shutdown(self):
+		"""Stop workers without waiting for queued jobs"""
+		if self.pool is not None:
+			self.pool.shutdown(wait=False, cancel_futures=True)
+			self.pool = None
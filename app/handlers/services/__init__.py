@@ -1,4 +1,4 @@
-__all__ = ['diceservice', 'ichingservice', 'tarotservice', 'factservice']
+__all__ = ['diceservice', 'ichingservice', 'tarotservice', 'factservice', 'imageencoder']
 
 '''
 Apparently things need to go here in order to do
@@ -0,0 +1,67 @@
+import threading
+from collections import OrderedDict
+
+# CLASS
+
+class ByteLimitedCache:
+	"""Process-wide LRU cache bounded by the total size in bytes of its values (measured by size_of())."""
+	def __init__(self, max_bytes):
+		self.max_bytes = max_bytes
+		self.entries = OrderedDict()
+		self.size = 0
+
+		# Counters for monitoring
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+		# Shared by every service instance, so guard against concurrent jobs in worker threads
+		self.lock = threading.Lock()
+
+	def size_of(self, value):
+		"""Bytes counted against max_bytes for value"""
+		return len(value)
+
+	def get(self, key):
+		"""Return cached value for key (marking it most recently used) or None if not cached"""
+		with self.lock:
+			entry = self.entries.get(key)
+			if entry is None:
+				self.misses += 1
+				return None
+
+			self.entries.move_to_end(key)
+			self.hits += 1
+			return entry[0]
+
+	def put(self, key, value):
+		"""Cache value under key, evicting least recently used values until under max_bytes"""
+		size = self.size_of(value)
+
+		# Never cache something that would evict everything else
+		if size > self.max_bytes:
+			return
+
+		with self.lock:
+			if key in self.entries:
+				self.size -= self.entries.pop(key)[1]
+
+			self.entries[key] = (value, size)
+			self.size += size
+
+			while self.size > self.max_bytes:
+				old_key, (old_value, old_size) = self.entries.popitem(last=False)
+				self.size -= old_size
+				self.evictions += 1
+
+	def stats(self):
+		"""Return dict of counters and current usage for monitoring"""
+		with self.lock:
+			return {
+				'entries': len(self.entries),
+				'bytes': self.size,
+				'max_bytes': self.max_bytes,
+				'hits': self.hits,
+				'misses': self.misses,
+				'evictions': self.evictions
+			}
@@ -0,0 +1,172 @@
+import asyncio
+import os
+import random
+import time
+
+# ERRORS
+
+class Error(Exception):
+	"""Generic error to extend"""
+	pass
+
+class CircuitOpenError(Error):
+	"""The backend failed repeatedly, so calls fail fast until it's back."""
+	pass
+
+class DeadlineExceededError(Error):
+	"""The call didn't finish within its deadline."""
+	pass
+
+
+# CLASS
+
+class CircuitBreaker:
+	"""Guards calls to a backend (Redis, MySQL) with a deadline per attempt, retries with jittered backoff, and a circuit breaker.
+
+	After `threshold` calls in a row fail, the breaker opens and calls raise CircuitOpenError straight away.
+	With a probe (a coroutine function doing the cheapest possible round trip), it's run in the background
+	with growing, jittered delays until it succeeds and the breaker closes. Without one, the first call
+	after `cooldown` seconds is let through as a trial (half-open), closing the breaker if it succeeds.
+
+	Settings not passed in come from environment variables:
+	 • `BREAKER_THRESHOLD`: Failed calls in a row before the breaker opens (default 3)
+	 • `BREAKER_COOLDOWN`: Seconds before the first probe or trial call (default 10)
+	"""
+	CLOSED = 'closed'
+	OPEN = 'open'
+	HALF_OPEN = 'half-open'
+
+	# Retry delays are random up to BACKOFF_BASE * 2^attempt, capped at BACKOFF_MAX seconds
+	BACKOFF_BASE = 0.1
+	BACKOFF_MAX = 2
+
+	# Probe delays double from the cooldown up to this many seconds
+	PROBE_DELAY_MAX = 60
+
+	def __init__(self, errors, deadline, retries=0, threshold=None, cooldown=None, probe=None, retry_deadlines=True):
+		self.errors = errors
+		self.deadline = deadline
+		self.retries = retries
+
+		# False for calls that keep running after their deadline (like blocking work in a thread), where a retry would only pile on
+		self.retry_deadlines = retry_deadlines
+		self.threshold = threshold or int(os.environ.get('BREAKER_THRESHOLD', 3))
+		self.cooldown = cooldown or float(os.environ.get('BREAKER_COOLDOWN', 10))
+		self.probe = probe
+
+		self.state = CircuitBreaker.CLOSED
+		self.consecutive_failures = 0
+		self.opened_at = 0
+		self.probe_task = None
+
+		# Counters for monitoring
+		self.calls = 0
+		self.failures = 0
+		self.timeouts = 0
+		self.retries_made = 0
+		self.rejected = 0
+		self.probes = 0
+		self.state_changes = 0
+
+	def set_state(self, state):
+		"""Change state, counting the change"""
+		if state != self.state:
+			self.state = state
+			self.state_changes += 1
+
+	def allow(self):
+		"""Returns bool if a call may go through now (moving to half-open for a trial call if it's time)"""
+		if self.state == CircuitBreaker.CLOSED:
+			return True
+
+		if self.state == CircuitBreaker.OPEN and self.probe is None and time.monotonic() - self.opened_at >= self.cooldown:
+			self.set_state(CircuitBreaker.HALF_OPEN)
+			return True
+
+		# Open, or half-open with the trial call still running
+		return False
+
+	def backoff(self, attempt):
+		"""Return seconds to wait before retry number attempt + 1 ("full jitter", so retries from many requests spread out)"""
+		return random.uniform(0, min(CircuitBreaker.BACKOFF_MAX, CircuitBreaker.BACKOFF_BASE * 2 ** attempt))
+
+	async def call(self, func, *args, retry=True):
+		"""Await func(*args) within the deadline, retrying failures if retry (only for calls safe to repeat). Raises CircuitOpenError, DeadlineExceededError, or the backend's error."""
+		if not self.allow():
+			self.rejected += 1
+			raise CircuitOpenError()
+
+		self.calls += 1
+		attempts = self.retries + 1 if retry and self.state == CircuitBreaker.CLOSED else 1
+
+		for attempt in range(attempts):
+			try:
+				result = await asyncio.wait_for(func(*args), self.deadline)
+			except asyncio.TimeoutError:
+				self.timeouts += 1
+				error = DeadlineExceededError()
+				if not self.retry_deadlines:
+					break
+			except self.errors as e:
+				error = e
+			else:
+				self.record_success()
+				return result
+
+			if attempt + 1 < attempts:
+				self.retries_made += 1
+				await asyncio.sleep(self.backoff(attempt))
+
+		self.record_failure()
+		raise error
+
+	def record_success(self):
+		"""Reset failure count and close breaker"""
+		self.consecutive_failures = 0
+		self.set_state(CircuitBreaker.CLOSED)
+
+	def record_failure(self):
+		"""Count failed call, opening breaker at the threshold (or straight away if it was the trial call)"""
+		self.failures += 1
+		self.consecutive_failures += 1
+		if self.state == CircuitBreaker.HALF_OPEN or self.consecutive_failures >= self.threshold:
+			self.open()
+
+	def open(self):
+		"""Open breaker and start probing in the background if there's a probe"""
+		self.set_state(CircuitBreaker.OPEN)
+		self.opened_at = time.monotonic()
+
+		if self.probe is not None and (self.probe_task is None or self.probe_task.done()):
+			self.probe_task = asyncio.create_task(self.probe_until_closed())
+
+	async def probe_until_closed(self):
+		"""Run probe with growing, jittered delays until it succeeds, then close breaker"""
+		attempt = 0
+		while self.state != CircuitBreaker.CLOSED:
+			delay = min(CircuitBreaker.PROBE_DELAY_MAX, self.cooldown * 2 ** attempt)
+			await asyncio.sleep(delay * random.uniform(0.5, 1))
+			attempt += 1
+
+			self.probes += 1
+			try:
+				await asyncio.wait_for(self.probe(), self.deadline)
+			except Exception:
+				# Any error (not just the backend's usual ones) is a failed probe: if this task died,
+				# nothing would close the breaker again
+				continue
+
+			self.record_success()
+
+	def stats(self):
+		"""Return dict of state and counters for monitoring"""
+		return {
+			'state': self.state,
+			'calls': self.calls,
+			'failures': self.failures,
+			'timeouts': self.timeouts,
+			'retries': self.retries_made,
+			'rejected': self.rejected,
+			'probes': self.probes,
+			'state_changes': self.state_changes
+		}
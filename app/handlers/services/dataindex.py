@@ -0,0 +1,88 @@
+import os
+import sys
+import json
+import time
+import threading
+from types import MappingProxyType
+
+# CLASS
+
+class DataIndex:
+	"""Process-wide, read-only index of a JSON data file's records keyed by their 'id'.
+
+	The file is parsed on first use into immutable records (record_type is a namedtuple whose fields
+	name the JSON keys to keep; lists become tuples) and then shared by every service instance. It's
+	re-parsed if the file's modification time changes, checked at most every CHECK_INTERVAL seconds.
+	"""
+	CHECK_INTERVAL = 5
+
+	def __init__(self, path, record_type):
+		self.path = path
+		self.record_type = record_type
+
+		self.records = None
+		self.mapping_bytes = 0
+		self.mtime = None
+		self.last_check = 0
+		self.lock = threading.Lock()
+
+		# For monitoring
+		self.loads = 0
+		self.load_seconds = 0.0
+
+	def load(self):
+		"""Parse file into a read-only {id: record} mapping and remember when the file was modified"""
+		start = time.perf_counter()
+
+		mtime = os.stat(self.path).st_mtime
+		with open(self.path, encoding='utf-8') as f:
+			data = json.load(f)
+
+		records = {}
+		for item in data:
+			values = [item[field] for field in self.record_type._fields]
+			values = [tuple(value) if isinstance(value, list) else value for value in values]
+			records[item['id']] = self.record_type(*values)
+
+		self.records = MappingProxyType(records)
+		self.mapping_bytes = sys.getsizeof(records)
+		self.mtime = mtime
+		self.loads += 1
+		self.load_seconds = time.perf_counter() - start
+
+	def get(self):
+		"""Return {id: record} mapping, loading it first or reloading it if the file changed"""
+		now = time.monotonic()
+		if self.records is not None and now - self.last_check < DataIndex.CHECK_INTERVAL:
+			return self.records
+
+		with self.lock:
+			if self.records is None or os.stat(self.path).st_mtime != self.mtime:
+				self.load()
+			self.last_check = now
+
+		return self.records
+
+	def memory_bytes(self):
+		"""Approximate memory held by the index (mapping, records, and their values)"""
+		if self.records is None:
+			return 0
+
+		total = sys.getsizeof(self.records) + self.mapping_bytes
+		for record in self.records.values():
+			total += sys.getsizeof(record)
+			for value in record:
+				total += sys.getsizeof(value)
+				if isinstance(value, tuple):
+					total += sum(sys.getsizeof(item) for item in value)
+
+		return total
+
+	def stats(self):
+		"""Return dict of size and load counters for monitoring"""
+		return {
+			'records': 0 if self.records is None else len(self.records),
+			'loads': self.loads,
+			'load_ms': round(self.load_seconds * 1000, 2),
+			'bytes': self.memory_bytes()
+		}
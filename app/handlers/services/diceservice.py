@@ -1,5 +1,11 @@
+import os
 import re
+from math import comb
 from random import randint
+from functools import lru_cache, wraps
+from collections import namedtuple
+import numpy as np
+from app.handlers.services.bytecache import ByteLimitedCache
 
 # ERRORS
 
@@ -11,116 +17,773 @@ class ExcessiveQuantityError(Error):
 	"""The user was having fun testing how high the numbers go."""
 	pass
 
-class MalformedInputError(Error):
-	"""The user's string is no good."""
+class TooManyOutcomesError(Error):
+	"""The equation has too many possible totals to work out its exact distribution."""
+	pass
+
+class UnsupportedStatsError(Error):
+	"""The equation's exact distribution is too costly (or not implemented) for its mix of keep/drop and exploding dice."""
 	pass
 
+class MalformedInputError(Error):
+	"""The user's string is no good. Knows where (position in the string) and why (reason)."""
+	def __init__(self, position=None, reason=None):
+		super().__init__(reason)
+		self.position = position
+		self.reason = reason
+
+
+# LIMITS
+
+# Equations with fewer dice than this list every roll
+SMALL_POOL_DICE = 100
+
+# Bigger equations are rolled with NumPy and summarized, up to these limits
+MAX_DICE = 10000000
+MAX_FACES = 1000000
+
+# Dice drawn per NumPy batch, to bound memory for huge pools (keep/drop pools must fit in one batch)
+CHUNK_SIZE = 1000000
+
+# Most times one exploding die rolls again
+MAX_EXPLOSION_DEPTH = 20
+
+# Histogram buckets for summarized pools (dice with this many faces or fewer get one per face)
+HISTOGRAM_BINS = 12
+HISTOGRAM_WIDTH = 20
+
+# Exact distributions are worked out for equations with up to this many possible totals
+MAX_STATS_OUTCOMES = 1000000
+
+# Convolutions where both sides are at least this long use FFT instead of direct multiplication
+FFT_THRESHOLD = 64
+
+# FFT results below this fraction of their peak are rounding noise, so they're zeroed
+FFT_NOISE_FLOOR = 1e-15
+
+# Chances below this are reported as `< 1e-12%`, since FFT noise swamps them
+PROBABILITY_FLOOR = 1e-14
+
+# Most steps (faces × dice²) spent on the exact distribution of a keep/drop term
+MAX_KEEP_STATS_STEPS = 100000
+
+# Percentiles reported by `))dice stats`
+PERCENTILES = (5, 25, 50, 75, 95)
+
+# Most repetitions of one equation (`x N` or `repeat=N`) in a message
+MAX_REPEATS = 1000000
+
+# Characters repeated rolls may take up before they're summarized instead (Discord messages max out at 2000)
+OUTPUT_BUDGET = 1800
+
+
+# EXPRESSIONS
+
+# A parsed equation: its terms, normalized text (lowercase, no spaces) for special-case checks, and its number of dice
+Expression = namedtuple('Expression', ['terms', 'text', 'dice_count'])
+
+# Summary of a rolled pool: sum of kept rolls, smallest and largest roll, and histogram as list of (low face, high face or None for "and up", count)
+PoolSummary = namedtuple('PoolSummary', ['total', 'min', 'max', 'histogram'])
+
+# Terms, each with sign 1 or -1. Dice keep `keep` of their rolls (all of them unless `kh`/`kl`/`dh`/`dl` was used), highest first unless keep_highest is False.
+Constant = namedtuple('Constant', ['sign', 'value'])
+Dice = namedtuple('Dice', ['sign', 'count', 'faces', 'explode', 'keep', 'keep_highest'])
+
+# Tokens: 'number', 'keep' (`kh`, `kl`, `k`, `dh`, `dl`), 'd', 'operator', 'explode' (`!`), or 'unexpected', with position in the original string
+Token = namedtuple('Token', ['kind', 'text', 'position'])
+TOKEN_PATTERN = re.compile(r'(\d+)|([kK][hHlL]?|[dD][hHlL])|([dD])|([+-])|(!)|(\S)')
+
+# Trailing `>= X` (or `≥ X`) on `))dice stats` equations
+STATS_THRESHOLD_PATTERN = re.compile(r'(?:>=|≥)\s*(-?\d+)\s*$')
+
+# Trailing `x N` or `repeat=N` to roll an equation N times
+REPEAT_PATTERN = re.compile(r'(?:x|repeat\s*=)\s*(\d+)\s*$', re.IGNORECASE)
+
+def split_repeats(s):
+	"""Split equation string into (equation, repeats), where repeats is None if there's no `x N` or `repeat=N` suffix"""
+	match = REPEAT_PATTERN.search(s)
+	if match is None:
+		return s, None
+	return s[:match.start()], int(match.group(1))
+
+def tokenize(s):
+	"""Return list of Tokens in s, skipping whitespace"""
+	tokens = []
+	for match in TOKEN_PATTERN.finditer(s):
+		kind = ('number', 'keep', 'd', 'operator', 'explode', 'unexpected')[match.lastindex - 1]
+		tokens.append(Token(kind, match.group(), match.start()))
+	return tokens
+
+@lru_cache(maxsize=512)
+def compile_expression(s):
+	"""Parse dice equation string into an Expression (cached, so repeated equations are parsed once). Raises MalformedInputError or ExcessiveQuantityError."""
+	tokens = tokenize(s)
+	if len(tokens) == 0:
+		raise MalformedInputError(0, 'expected a die (like `1d20`) or a number')
+
+	terms = []
+	sign = 1
+	i = 0
+
+	# Only complain about size once the whole equation is known to be well-formed
+	excessive = False
+
+	while True:
+		# Expect a term: number, or number 'd' number
+		token = tokens[i] if i < len(tokens) else None
+		if token is None or token.kind != 'number':
+			position = len(s) if token is None else token.position
+			raise MalformedInputError(position, 'expected a die (like `1d20`) or a number')
+
+		if i + 1 < len(tokens) and tokens[i+1].kind == 'd':
+			faces_token = tokens[i+2] if i + 2 < len(tokens) else None
+			if faces_token is None or faces_token.kind != 'number':
+				position = len(s) if faces_token is None else faces_token.position
+				raise MalformedInputError(position, 'expected number of die faces after `d`')
+
+			count, faces = int(token.text), int(faces_token.text)
+
+			# Numbers are ridiculous
+			if faces > MAX_FACES:
+				excessive = True
+
+			if faces < 1:
+				raise MalformedInputError(faces_token.position, 'dice need at least 1 face')
+
+			i += 3
+
+			# Optional `!` to reroll and add dice that land on their top face
+			explode = False
+			if i < len(tokens) and tokens[i].kind == 'explode':
+				if faces == 1:
+					raise MalformedInputError(tokens[i].position, '1-sided dice would explode forever')
+				explode = True
+				i += 1
+
+			# Optional keep/drop, stored as how many of which end to keep
+			keep, keep_highest = count, True
+			if i < len(tokens) and tokens[i].kind == 'keep':
+				modifier = tokens[i].text.lower()
+				amount_token = tokens[i+1] if i + 1 < len(tokens) else None
+				if amount_token is None or amount_token.kind != 'number':
+					position = len(s) if amount_token is None else amount_token.position
+					raise MalformedInputError(position, 'expected number of dice after `{}`'.format(modifier))
+
+				amount = int(amount_token.text)
+				if amount > count:
+					raise MalformedInputError(amount_token.position, 'only {} dice to {}'.format(count, 'keep' if modifier[0] == 'k' else 'drop'))
+
+				if modifier[0] == 'k':
+					keep, keep_highest = amount, modifier != 'kl'
+				else:
+					keep, keep_highest = count - amount, modifier == 'dl'
+
+				# Selection needs the whole pool in memory at once
+				if count > CHUNK_SIZE:
+					excessive = True
+
+				i += 2
+
+			terms.append(Dice(sign, count, faces, explode, keep, keep_highest))
+		else:
+			terms.append(Constant(sign, int(token.text)))
+			i += 1
+
+		# Expect end of equation or an operator
+		if i == len(tokens):
+			break
+
+		if tokens[i].kind != 'operator':
+			raise MalformedInputError(tokens[i].position, 'expected `+` or `-`')
+
+		sign = 1 if tokens[i].text == '+' else -1
+		i += 1
+
+	dice_count = sum(term.count for term in terms if isinstance(term, Dice))
+
+	if excessive or dice_count > MAX_DICE:
+		raise ExcessiveQuantityError()
+
+	text = ''.join(token.text for token in tokens).lower()
+	return Expression(tuple(terms), text, dice_count)
+
+def term_text(term):
+	"""Return Dice term written out like `4d6!kh3` (drops are shown as the matching keep)"""
+	text = '{}{}d{}'.format('-' if term.sign < 0 else '', term.count, term.faces)
+	if term.explode:
+		text += '!'
+	if term.keep < term.count:
+		text += '{}{}'.format('kh' if term.keep_highest else 'kl', term.keep)
+	return text
+
+
+# ROLLING
+
+def roll_values(rng, faces, explode, shape):
+	"""Return NumPy array of rolls with given shape, adding rerolls to exploding dice up to MAX_EXPLOSION_DEPTH times"""
+	values = rng.integers(1, faces, size=shape, endpoint=True)
+
+	if explode:
+		# Only the dice that just hit their top face roll again
+		exploding = np.nonzero(values == faces)
+		for depth in range(MAX_EXPLOSION_DEPTH):
+			if len(exploding[0]) == 0:
+				break
+			rerolls = rng.integers(1, faces, size=len(exploding[0]), endpoint=True)
+			values[exploding] += rerolls
+			exploding = tuple(index[rerolls == faces] for index in exploding)
+
+	return values
+
+def kept_mask(values, keep, keep_highest):
+	"""Return bool array marking the keep highest (or lowest) values along the last axis, found by partial selection rather than sorting"""
+	count = values.shape[-1]
+	if keep == count:
+		return np.ones(values.shape, dtype=bool)
+
+	mask = np.zeros(values.shape, dtype=bool)
+	if keep == 0:
+		return mask
+
+	if keep_highest:
+		indexes = np.argpartition(values, count - keep, axis=-1)[..., count - keep:]
+	else:
+		indexes = np.argpartition(values, keep - 1, axis=-1)[..., :keep]
+
+	np.put_along_axis(mask, indexes, True, axis=-1)
+	return mask
+
+def exploded_faces(value, faces):
+	"""Return faces an exploding die rolled to reach value (every top face rolls again, so there's only one way)"""
+	# A multiple of faces only happens when the last allowed reroll hit the top face too
+	if value % faces == 0:
+		return [faces] * (value // faces)
+	return [faces] * (value // faces) + [value % faces]
+
+def roll_text(faces, kept=True):
+	"""Return one die's roll for display: faces joined by `+` if it exploded, struck through if dropped"""
+	text = '+'.join(str(face) for face in faces)
+	return text if kept else '~~' + text + '~~'
+
+
+# DISTRIBUTIONS
+
+# Exact distribution of a total: probabilities[i] is the chance of rolling offset + i
+Distribution = namedtuple('Distribution', ['offset', 'probabilities'])
+
+def die_maximum(term):
+	"""Return highest roll one die of a Dice term can show"""
+	return term.faces * (MAX_EXPLOSION_DEPTH + 1) if term.explode else term.faces
+
+def keep_steps(count, faces):
+	"""Return rough cost (faces × dice²) of keep_distribution() for count dice of faces"""
+	return faces * (count + 1) ** 2
+
+def outcome_count(expression):
+	"""Return number of possible totals of expression"""
+	return 1 + sum(term.keep * (die_maximum(term) - 1) for term in expression.terms if isinstance(term, Dice))
+
+def convolve(a, b):
+	"""Multiply two probability polynomials, using FFT for long ones"""
+	if min(len(a), len(b)) < FFT_THRESHOLD:
+		return np.convolve(a, b)
+
+	length = len(a) + len(b) - 1
+	size = 1 << (length - 1).bit_length()
+	result = np.fft.irfft(np.fft.rfft(a, size) * np.fft.rfft(b, size), size)[:length]
+
+	# Rounding error leaves noise (even negative probabilities) around zero, where real tails would be far smaller
+	result[result < FFT_NOISE_FLOOR * result.max()] = 0
+	return result
+
+def die_distribution(faces, explode):
+	"""Return probabilities of one die rolling 1, 2, ... faces (or up to faces * (MAX_EXPLOSION_DEPTH + 1) if exploding)"""
+	if not explode:
+		return np.full(faces, 1 / faces)
+
+	# depth rerolls, then a roll below the top face (the last allowed reroll counts whatever it shows)
+	probabilities = np.zeros(faces * (MAX_EXPLOSION_DEPTH + 1))
+	for depth in range(MAX_EXPLOSION_DEPTH + 1):
+		last = faces if depth == MAX_EXPLOSION_DEPTH else faces - 1
+		probabilities[depth * faces:depth * faces + last] = (1 / faces) ** (depth + 1)
+
+	return probabilities
+
+def dice_distribution(count, faces, explode=False):
+	"""Return probabilities of count dice of faces summing to count, count + 1, ... (polynomial power by squaring)"""
+	result = np.ones(1)
+	base = die_distribution(faces, explode)
+
+	while count > 0:
+		if count & 1:
+			result = convolve(result, base)
+		count >>= 1
+		if count > 0:
+			base = convolve(base, base)
+
+	return result
+
+def keep_distribution(count, faces, keep, keep_highest):
+	"""Return probabilities of the kept dice summing to keep, keep + 1, ... keep * faces.
+
+	Works down from the top face, tracking how many dice are placed and the kept sum so far. With m dice placed
+	on faces above v, the rest are uniform on 1..v, so how many land on v is binomial. Keep-lowest is the mirror image.
+	"""
+	if keep_steps(count, faces) > MAX_KEEP_STATS_STEPS:
+		raise UnsupportedStatsError()
+
+	# dp[m, s]: chance that exactly m dice landed above the current face with kept sum s
+	dp = np.zeros((count + 1, keep * faces + 1))
+	dp[0, 0] = 1
+
+	for face in range(faces, 0, -1):
+		p = 1 / face
+		placed = np.zeros_like(dp)
+
+		for m in range(count + 1):
+			if not dp[m].any():
+				continue
+
+			remaining = count - m
+			for j in range(remaining + 1):
+				weight = comb(remaining, j) * p ** j * (1 - p) ** (remaining - j)
+				if weight == 0:
+					continue
+
+				shift = min(j, max(0, keep - m)) * face
+				placed[m + j, shift:] += weight * dp[m, :dp.shape[1] - shift]
+
+		dp = placed
+
+	result = dp[count, keep:]
+	return result if keep_highest else result[::-1]
+
+class DistributionCache(ByteLimitedCache):
+	"""Process-wide LRU cache of (lowest total or offset, probabilities) pairs, bounded by the bytes of their arrays."""
+	def size_of(self, value):
+		return value[1].nbytes
+
+# Exact distributions by bytes rather than count, since one can be MAX_STATS_OUTCOMES floats (8 MB)
+distribution_cache = DistributionCache(int(os.environ.get('DICE_STATS_CACHE_BYTES', 32 * 1024 * 1024)))
+
+def cached_distribution(func):
+	"""Cache func's results in distribution_cache, keyed by its name and (hashable) arguments"""
+	@wraps(func)
+	def wrapper(*args):
+		key = (func.__name__,) + args
+		value = distribution_cache.get(key)
+		if value is None:
+			value = func(*args)
+			distribution_cache.put(key, value)
+		return value
+	return wrapper
+
+@cached_distribution
+def term_distribution(count, faces, explode, keep, keep_highest):
+	"""Return (lowest total, probabilities) for one added Dice term. Raises UnsupportedStatsError for exploding keep/drop dice or big keep/drop pools."""
+	if keep < count:
+		if explode:
+			raise UnsupportedStatsError()
+		probabilities = keep_distribution(count, faces, keep, keep_highest)
+		minimum = keep
+	else:
+		probabilities = dice_distribution(count, faces, explode)
+		minimum = count
+
+	probabilities.setflags(write=False)
+	return minimum, probabilities
+
+@cached_distribution
+def distribution(terms):
+	"""Return exact Distribution of the total of terms (cached, so repeat queries skip the convolutions)"""
+	offset = 0
+	probabilities = np.ones(1)
+
+	for term in terms:
+		if isinstance(term, Constant):
+			offset += term.sign * term.value
+		elif term.count > 0:
+			minimum, term_probabilities = term_distribution(term.count, term.faces, term.explode, term.keep, term.keep_highest)
+
+			# Subtracted dice: totals run from -highest up to -lowest
+			if term.sign < 0:
+				term_probabilities = term_probabilities[::-1]
+				offset -= minimum + len(term_probabilities) - 1
+			else:
+				offset += minimum
+
+			probabilities = convolve(probabilities, term_probabilities)
+
+	probabilities = probabilities / probabilities.sum()
+	probabilities.setflags(write=False)
+	return Distribution(offset, probabilities)
+
+def format_probability(p):
+	"""Return probability as a percentage, switching to scientific notation for tiny ones"""
+	if p == 0 or p >= 0.0001:
+		return '{:.2f}%'.format(p * 100)
+	return '{:.2e}%'.format(p * 100)
+
+def format_mean(total, count):
+	"""Return total / count to 3 decimal places, exactly even for ints too big for a float"""
+	thousandths = (total * 1000 * 2 + count) // (count * 2)
+	sign = '-' if thousandths < 0 else ''
+	whole, fraction = divmod(abs(thousandths), 1000)
+	return '{}{}.{:03d}'.format(sign, whole, fraction)
+
 
 # CLASS
 
 class DiceService:
-	def expected_characters(self, s):
-		"""Returns boolean if string has character that aren't digits, +, -, whitespace, or 'd'"""
-		result = bool(re.search('^[0-9\+\- d]*$', s))
-		return result
+	def calculate_die_rolls(self, dice):
+		"""Takes a Dice term and returns list of random rolls, each a list of faces (more than one if the die exploded)"""
+		rolls = []
+		for i in range(dice.count):
+			faces = [randint(1, dice.faces)]
+			while dice.explode and faces[-1] == dice.faces and len(faces) <= MAX_EXPLOSION_DEPTH:
+				faces.append(randint(1, dice.faces))
+			rolls.append(faces)
+		return rolls
+
+	def excessive_response(self):
+		"""Explain the size limits"""
+		return "Please use at most {:,} dice ({:,} when keeping or dropping) and {:,} die faces.".format(MAX_DICE, CHUNK_SIZE, MAX_FACES)
+
+	def is_small(self, expression):
+		"""Returns bool if expression is small enough to list every roll"""
+		return expression.dice_count < SMALL_POOL_DICE
+
+	def summarize_die_rolls(self, dice):
+		"""Roll a Dice term in NumPy batches and return PoolSummary (never holds more than CHUNK_SIZE rolls)"""
+		rng = np.random.default_rng()
+
+		# One bucket per face for small dice, otherwise even ranges of faces
+		bins = min(dice.faces, HISTOGRAM_BINS)
+		counts = np.zeros(bins, dtype=np.int64)
+		total = 0
+		smallest = dice.faces
+		largest = 1
+
+		remaining = dice.count
+		while remaining > 0:
+			rolls = roll_values(rng, dice.faces, dice.explode, min(remaining, CHUNK_SIZE))
+			remaining -= len(rolls)
+
+			# Keep/drop pools are never bigger than one batch, so this selects from the whole pool
+			if dice.keep < dice.count:
+				total += int(rolls[kept_mask(rolls, dice.keep, dice.keep_highest)].sum())
+			else:
+				total += int(rolls.sum())
+
+			smallest = min(smallest, int(rolls.min()))
+			largest = max(largest, int(rolls.max()))
+
+			# Exploded dice count towards the top bucket
+			counts += np.bincount((np.minimum(rolls, dice.faces) - 1) * bins // dice.faces, minlength=bins)
+
+		histogram = []
+		for i, count in enumerate(counts):
+			low = i * dice.faces // bins + 1
+			high = (i + 1) * dice.faces // bins
+			histogram.append((low, None if dice.explode and i == bins - 1 else high, int(count)))
+
+		return PoolSummary(total, smallest, largest, histogram)
+
+	def roll_summaries(self, expression):
+		"""Roll a compiled Expression in bulk, returning total and list of (Dice term, PoolSummary)"""
+		total = 0
+		summaries = []
+
+		for term in expression.terms:
+			if isinstance(term, Constant):
+				total += term.sign * term.value
+			elif term.count > 0:
+				summary = self.summarize_die_rolls(term)
+				summaries.append((term, summary))
+				total += term.sign * summary.total
+
+		return total, summaries
+
+	def summary_response(self, summaries):
+		"""Describe rolled pools (count, sum, mean, range) and a histogram of the biggest pool"""
+		lines = []
+		for term, summary in summaries:
+			mean = summary.total / term.keep if term.keep > 0 else 0
+			lines.append('{}: sum {:,}, mean {:.3f}, min {}, max {}'.format(term_text(term), summary.total, mean, summary.min, summary.max))
+
+		response = '\nRolled {:,} dice\n```\n{}\n```\n'.format(sum(term.count for term, summary in summaries), '\n'.join(lines))
+
+		term, summary = max(summaries, key=lambda item: item[0].count)
+		response += self.histogram_response(term_text(term._replace(sign=1)), summary.histogram, term.count)
+		return response
+
+	def histogram_response(self, title, histogram, n):
+		"""Draw histogram (list of (low, high, count) over n values) as bars scaled to the fullest bucket"""
+		fullest = max(count for low, high, count in histogram)
+		labels = []
+		for low, high, count in histogram:
+			if high is None:
+				labels.append('{}+'.format(low))
+			else:
+				labels.append(str(low) if low == high else '{}-{}'.format(low, high))
+
+		label_width = max(len(label) for label in labels)
+
+		rows = []
+		for label, (low, high, count) in zip(labels, histogram):
+			bar = '█' * round(HISTOGRAM_WIDTH * count / fullest) if fullest > 0 else ''
+			rows.append('{} {:<{}} {:>6.2%}'.format(label.rjust(label_width), bar, HISTOGRAM_WIDTH, count / n))
+
+		return 'Histogram ({}):\n```\n{}\n```'.format(title, '\n'.join(rows))
+
+	def roll_repeated(self, expression, repeats, keep_rolls):
+		"""Roll a compiled Expression repeats times in one vectorized pass. Returns the constants' sum, array of dice totals (add the two for each total) and, if keep_rolls, (repeats, dice) arrays of rolls and whether each was kept."""
+		rng = np.random.default_rng()
+
+		# Constants stay a Python int (any size), only dice go in the int64 array (MAX_DICE and MAX_FACES keep them well within it)
+		offset = sum(term.sign * term.value for term in expression.terms if isinstance(term, Constant))
+		totals = np.zeros(repeats, dtype=np.int64)
+		kept = []
+		masks = []
+
+		for term in expression.terms:
+			if isinstance(term, Constant):
+				continue
+
+			if term.count == 0:
+				continue
+
+			# Whole rows at a time, with no more than CHUNK_SIZE rolls in memory
+			rows = max(1, CHUNK_SIZE // term.count)
+			for start in range(0, repeats, rows):
+				stop = min(start + rows, repeats)
+				if term.count > CHUNK_SIZE:
+					sums = [self.summarize_die_rolls(term).total for i in range(start, stop)]
+				else:
+					rolls = roll_values(rng, term.faces, term.explode, (stop - start, term.count))
+					mask = kept_mask(rolls, term.keep, term.keep_highest)
+					sums = np.where(mask, rolls, 0).sum(axis=1)
+					if keep_rolls:
+						kept.append(rolls)
+						masks.append(mask)
+				totals[start:stop] += term.sign * np.asarray(sums, dtype=np.int64)
+
+		if keep_rolls and len(kept) > 0:
+			return offset, totals, np.concatenate(kept, axis=1), np.concatenate(masks, axis=1)
+		return offset, totals, None, None
+
+	def repeat_response(self, expression, repeats):
+		"""Roll a compiled Expression repeats times and describe every result, or summarize them if they won't fit OUTPUT_BUDGET"""
+		if repeats < 1 or repeats > MAX_REPEATS:
+			return 'Please repeat equations from 1 to {:,} times.'.format(MAX_REPEATS)
+		if expression.dice_count * repeats > MAX_DICE:
+			return 'Please use at most {:,} dice across all repeats.'.format(MAX_DICE)
+
+		# Individual rolls only shown for small equations, and only if everything fits
+		small = self.is_small(expression) and expression.dice_count * repeats * 2 < OUTPUT_BUDGET
+		offset, totals, rolls, masks = self.roll_repeated(expression, repeats, small)
+
+		header = 'Rolled `{}` {:,} times:\n'.format(expression.text, repeats)
+
+		# One line per repeat
+		if repeats * 8 < OUTPUT_BUDGET:
+			# Faces of each column of rolls, if its dice explode (shown as chains like a single roll's)
+			exploding = [term.faces if term.explode else None for term in expression.terms if isinstance(term, Dice) for i in range(term.count)]
+
+			lines = []
+			for i, dice_total in enumerate(totals):
+				total = offset + int(dice_total)
+				line = '#{}: **{}**'.format(i + 1, total)
+				if rolls is not None and rolls.shape[1] > 1:
+					line += ' ({})'.format(', '.join(
+						roll_text([int(roll)] if faces is None else exploded_faces(int(roll), faces), kept)
+						for roll, kept, faces in zip(rolls[i], masks[i], exploding)
+					))
+				if expression.text == '1d20' and total in (1, 20):
+					line += ' critical hit!' if total == 20 else ' critical miss!'
+				lines.append(line)
+
+			response = header + '\n'.join(lines)
+			if len(response) <= OUTPUT_BUDGET:
+				return response
+
+			# Just the totals
+			response = header + 'Totals: ' + ', '.join(str(offset + int(dice_total)) for dice_total in totals)
+			if len(response) <= OUTPUT_BUDGET:
+				return response
+
+		# Too many to list: describe the totals instead
+		smallest, largest = int(totals.min()), int(totals.max())
+		total_sum = offset * repeats + int(totals.sum())
+		response = header + 'Sum of totals: **{}**\n```\nmean {}, min {}, max {}\n```\n'.format(total_sum, format_mean(total_sum, repeats), offset + smallest, offset + largest)
+
+		span = largest - smallest + 1
+		bins = min(span, HISTOGRAM_BINS)
+		counts = np.bincount((totals - smallest) * bins // span, minlength=bins)
+		low = offset + smallest
+		histogram = [(low + i * span // bins, low + (i + 1) * span // bins - 1, int(count)) for i, count in enumerate(counts)]
+
+		return response + self.histogram_response('totals', histogram, repeats)
+
+	def stats(self, expression):
+		"""Return mean, variance and dict of {percentile: total} for a compiled Expression. Raises TooManyOutcomesError or UnsupportedStatsError."""
+		if outcome_count(expression) > MAX_STATS_OUTCOMES:
+			raise TooManyOutcomesError()
+
+		# Mean and variance are exact from the dice themselves
+		mean = 0
+		variance = 0
+		for term in expression.terms:
+			if isinstance(term, Constant):
+				mean += term.sign * term.value
+			elif term.explode or term.keep < term.count:
+				# No closed form, so use the term's own distribution
+				minimum, probabilities = term_distribution(term.count, term.faces, term.explode, term.keep, term.keep_highest)
+				values = np.arange(minimum, minimum + len(probabilities))
+				term_mean = float((probabilities * values).sum())
+				mean += term.sign * term_mean
+				variance += float((probabilities * (values - term_mean) ** 2).sum())
+			else:
+				mean += term.sign * term.count * (term.faces + 1) / 2
+				variance += term.count * (term.faces ** 2 - 1) / 12
+
+		# Order doesn't matter to the total, so equivalent equations share a cache entry
+		offset, probabilities = distribution(tuple(sorted(expression.terms)))
+		cdf = np.cumsum(probabilities)
+
+		percentiles = {}
+		for percentile in PERCENTILES:
+			index = min(int(np.searchsorted(cdf, percentile / 100 - 1e-12)), len(cdf) - 1)
+			percentiles[percentile] = offset + index
+
+		return mean, variance, percentiles
+
+	def chance_at_least(self, expression, threshold):
+		"""Return probability that a compiled Expression totals threshold or more"""
+		offset, probabilities = distribution(tuple(sorted(expression.terms)))
+		index = threshold - offset
+
+		if index <= 0:
+			return 1.0
+		return float(probabilities[index:].sum())
+
+	def stats_response(self, s):
+		"""Takes in string like `4d6-1d4+3 >= 15`, returns exact distribution summary of the equation"""
+		if s is None:
+			s = ''
+
+		# Optional threshold for P(total >= X)
+		threshold = None
+		match = STATS_THRESHOLD_PATTERN.search(s)
+		if match:
+			threshold = int(match.group(1))
+			s = s[:match.start()]
 
-	def is_int(self, s):
-		"""Returns boolean if string can be converted to an integer"""
 		try:
-			int(s)
-			return True
-		except ValueError:
-			return False
-
-	def is_die(self, s):
-		"""Returns bool if string is 'd' surrounded by any positive number of digits"""
-		result = bool(re.search('^\d+d\d+$', s))
-		return result
-
-	def calculate_die_rolls(self, die):
-		"""Takes a correctly formatted string for die and returns list of random rolls"""
-		d_index = die.find('d')
-		multiplier, faces = die[:d_index], die[d_index+1:]
-		multiplier, faces = int(multiplier), int(faces)
-
-		# Raise ExcessiveQuantityError if numbers are ridiculous
-		if multiplier >= 100 or faces >= 1000:
-			raise ExcessiveQuantityError()
-
-		# Raise MalformedInputError if faces < 1
-		if faces < 1:
-			raise MalformedInputError()
-
-		rolls = [randint(1,faces) for roll in range(multiplier)]
-		return rolls
+			expression = compile_expression(s)
+			mean, variance, percentiles = self.stats(expression)
+		except MalformedInputError as e:
+			return self.error_response(s, e)
+		except ExcessiveQuantityError:
+			return self.excessive_response()
+		except TooManyOutcomesError:
+			return 'That equation has more than {:,} possible totals. Try fewer or smaller dice.'.format(MAX_STATS_OUTCOMES)
+		except UnsupportedStatsError:
+			return 'Exact stats for keep/drop dice only work on small pools that don\'t explode.'
 
-	def convert_possible_negative(self, s):
-		"""If die is negative, return positive die and -1 to multiply by. Otherwise returns 1 and original string."""
-		if s[0] == '-':
-			return -1, s[1:]
-		else:
-			return 1, s
+		offset, probabilities = distribution(tuple(sorted(expression.terms)))
 
-	def process(self, s):
-		"""Takes in string, returns result int and list of individual rolls"""
+		lines = [
+			'Range: {} to {}'.format(offset, offset + len(probabilities) - 1),
+			'Mean: {:.3f}'.format(mean),
+			'Variance: {:.3f} (std dev {:.3f})'.format(variance, variance ** 0.5),
+			'Percentiles: ' + ', '.join('{}%: {}'.format(percentile, total) for percentile, total in percentiles.items())
+		]
+
+		if threshold is not None:
+			probability = self.chance_at_least(expression, threshold)
+
+			# Possible, but too unlikely to tell from rounding noise
+			if probability < PROBABILITY_FLOOR and threshold < offset + len(probabilities):
+				chance = '< {:g}%'.format(PROBABILITY_FLOOR * 100)
+			else:
+				chance = format_probability(probability)
+
+			lines.append('P(total ≥ {}): {}'.format(threshold, chance))
 
+		return 'Stats for `{}`:\n```\n{}\n```'.format(s.strip().replace('`', "'"), '\n'.join(lines))
+
+	def roll(self, expression):
+		"""Roll a compiled Expression, returning total and list of individual die rolls (as display text)"""
 		total_rolls = []
 		total = 0
 
-		try:
-			# Ignore case (convert all to lowercase)
-			s = s.lower()
-
-			# Raise MalformedInputError if unexpected characters
-			if not self.expected_characters(s):
-				raise MalformedInputError()
-
-			# Remove all spaces
-			s = s.replace(' ', '')
-
-			# Replace -'s with +- for consistent addition and easy splitting
-			s = s.replace('-', '+-')
-
-			# Split string by +'s
-			segments = s.split('+')
-
-			# Raise MalformedInputError if any blank segments (+ at start/end, multiple +'s in row)
-			if '' in segments:
-				raise MalformedInputError()
-
-			# Parse each segment and add to total
-			for segment in segments:
-				# Convert to positive with multiplier
-				multiplier, positive_segment = self.convert_possible_negative(segment)
-
-				# If int, add to total
-				# (positive_segment not necessary because int() handles negatives)
-				if self.is_int(segment):
-					total += int(segment)
-				# If die, calculate rolls list and add sum to total
-				elif self.is_die(positive_segment):
-					rolls = self.calculate_die_rolls(positive_segment)
-					total_rolls += rolls
-					total += multiplier * sum(rolls)
-				# If not integer or die, raise error
-				else:
-					raise MalformedInputError()
-		except MalformedInputError:
+		for term in expression.terms:
+			if isinstance(term, Constant):
+				total += term.sign * term.value
+			else:
+				rolls = self.calculate_die_rolls(term)
+				values = np.array([sum(faces) for faces in rolls], dtype=np.int64)
+				kept = kept_mask(values, term.keep, term.keep_highest)
+
+				total_rolls += [roll_text(faces, is_kept) for faces, is_kept in zip(rolls, kept)]
+				total += term.sign * int(values[kept].sum())
+
+		return total, total_rolls
+
+	def error_response(self, s, error):
+		"""Explain where and why input couldn't be parsed, pointing at the spot with a caret"""
+		# Nothing to point at
+		if error.position is None or s.strip() == '':
 			return 'Could not parse input. For formatting help, use `))help dice`.'
+
+		response = 'Could not parse input at character {}: {}'.format(error.position + 1, error.reason)
+
+		# Backticks would end the code block early
+		response += '\n```\n{}\n{}^```'.format(s.replace('`', "'"), ' ' * error.position)
+		response += '\nFor formatting help, use `))help dice`.'
+		return response
+
+	def process(self, s):
+		"""Takes in string, returns response with result total and individual rolls"""
+		if s is None:
+			s = ''
+
+		s, repeats = split_repeats(s)
+
+		try:
+			expression = compile_expression(s)
+		except MalformedInputError as e:
+			return self.error_response(s, e)
 		except ExcessiveQuantityError:
-			return "Please use multipliers below 100 and die faces below 1000."
+			return self.excessive_response()
+
+		# Same equation rolled many times, parsed once
+		if repeats is not None:
+			return self.repeat_response(expression, repeats)
+
+		# Big pools get a summary instead of every roll
+		if not self.is_small(expression):
+			total, summaries = self.roll_summaries(expression)
+
+			response = 'Total: **' + str(total) + '**'
+			if len(summaries) > 0:
+				response += self.summary_response(summaries)
+			return response
+
+		total, total_rolls = self.roll(expression)
 
 		# Build response
 		response = ""
 
-		# Add snark if someone testing maximums
-		if s == '99d999':
+		# Add snark if someone testing the old maximums
+		if expression.text == '99d999':
 			response += '*...fine...*\n\n'
 
 		# Special scenarios for critical hits/misses on d20
-		if s == '1d20' and total == 20:
+		if expression.text == '1d20' and total == 20:
 			response += '**CRITICAL HIT!**\n'
-		if s == '1d20' and total == 1:
+		if expression.text == '1d20' and total == 1:
 			response += '**CRITICAL MISS!**\n'
 
 		# Print total in bold
@@ -128,7 +791,7 @@ class DiceService:
 
 		# Add individual rolls if more than 1
 		if len(total_rolls) > 1:
-			response += '\nIndividual rolls: ' + ', '.join([str(roll) for roll in total_rolls])
+			response += '\nIndividual rolls: ' + ', '.join(total_rolls)
 
 		# Add snark if no dice
 		if len(total_rolls) == 0:
@@ -138,3 +801,45 @@ class DiceService:
 			response += "\n\nNice."
 
 		return response
+
+
+# JOBS
+# Module-level so a RenderExecutor can run them in worker processes
+
+# Equations with at least this many dice are rolled in a worker
+WORKER_DICE = 100000
+
+def needs_worker(s):
+	"""Returns bool if equation s is big enough that rolling it would stall the event loop"""
+	s, repeats = split_repeats(s or '')
+
+	try:
+		return compile_expression(s).dice_count * (repeats or 1) >= WORKER_DICE or (repeats or 0) >= WORKER_DICE
+	except Error:
+		return False
+
+# Stats for equations with at least this many possible totals, or keep/drop dice costing this many steps (pure Python, a few µs each), are worked out in a worker
+WORKER_OUTCOMES = 20000
+WORKER_KEEP_STEPS = 10000
+
+def process(s):
+	"""Return DiceService response for equation s"""
+	return DiceService().process(s)
+
+def stats_needs_worker(s):
+	"""Returns bool if working out the distribution of equation s would stall the event loop"""
+	match = STATS_THRESHOLD_PATTERN.search(s or '')
+	if match:
+		s = s[:match.start()]
+
+	try:
+		expression = compile_expression(s or '')
+	except Error:
+		return False
+
+	steps = sum(keep_steps(term.count, term.faces) for term in expression.terms if isinstance(term, Dice) and term.keep < term.count)
+	return outcome_count(expression) >= WORKER_OUTCOMES or steps >= WORKER_KEEP_STEPS
+
+def stats_process(s):
+	"""Return DiceService stats response for equation s"""
+	return DiceService().stats_response(s)
@@ -1,10 +1,17 @@
-import redis
+import asyncio
+import redis.asyncio as redis
 import os
+import sqlite3
+from collections import deque
+from functools import partial
 from datetime import datetime, timezone, timedelta
 from zoneinfo import ZoneInfo
 import mysql.connector
+from mysql.connector import pooling
 from redis.exceptions import RedisError
 import random
+from app.handlers.services import circuitbreaker
+from app.handlers.services.circuitbreaker import CircuitBreaker
 
 
 class DatabaseError(Exception):
@@ -12,61 +19,361 @@ class DatabaseError(Exception):
 	pass
 
 
+# SCRIPTS
+# Recently used fact ids are kept in a list (newest first, at most RECENT_IDS_SIZE long) and every other id
+# in a set of fresh ones, so picking a fresh fact is an SPOP and retiring the oldest recent one is an RPOP + SADD.
+# Both live in Redis, so every bot process shares them.
+
+# Daily request counts are fields of one hash per MST day (`facttries:2024-01-31`), which expires whole at midnight.
+
+# Count a user's request and, if they're under the daily max, pick a fact, all in one round trip.
+# KEYS: today's counts hash, recent facts list, fresh facts set. ARGV: next midnight (unix time), daily max, recent list size, user id.
+# Returns {count} if over the max (or there's nothing to pick), otherwise {count, picked id}.
+FACT_SCRIPT = """
+local count = redis.call('HINCRBY', KEYS[1], ARGV[4], 1)
+if count == 1 then
+	redis.call('EXPIREAT', KEYS[1], ARGV[1], 'NX')
+end
+if count > tonumber(ARGV[2]) then
+	return {count}
+end
+
+-- Nothing fresh (fact table no bigger than the recent list): reuse the oldest recent fact
+local picked = redis.call('SPOP', KEYS[3])
+if not picked then
+	picked = redis.call('RPOP', KEYS[2])
+end
+if not picked then
+	return {count}
+end
+
+redis.call('LPUSH', KEYS[2], picked)
+if redis.call('LLEN', KEYS[2]) > tonumber(ARGV[3]) then
+	redis.call('SADD', KEYS[3], redis.call('RPOP', KEYS[2]))
+end
+return {count, picked}
+"""
+
+# Rebuild the fresh facts set from every fact id, leaving out recent ones and dropping ids no longer in the table.
+# KEYS: recent facts list, fresh facts set. ARGV: every fact id.
+SYNC_SCRIPT = """
+local recent = {}
+for _, id in ipairs(redis.call('LRANGE', KEYS[1], 0, -1)) do
+	recent[id] = true
+end
+
+redis.call('DEL', KEYS[2])
+for i = 1, #ARGV do
+	if not recent[ARGV[i]] then
+		redis.call('SADD', KEYS[2], ARGV[i])
+	end
+end
+return redis.call('SCARD', KEYS[2])
+"""
+
+
+# PROBES
+# Cheapest round trips, run in the background by an open breaker to see if the backend is back
+
+async def probe_redis():
+	"""Ping Redis"""
+	await FactService().get_redis_conn().ping()
+
+async def probe_db():
+	"""Ping MySQL through the pool"""
+	await asyncio.to_thread(FactService().ping_db)
+
+
 class FactService:
+	"""Hands out Pojo Facts from MySQL, with per-user daily limits and recently-used facts tracked in Redis.
+
+	Redis is used through redis.asyncio and MySQL through a connection pool in worker threads, so requests
+	don't block the event loop. Facts are loaded in the background at startup and new ones picked up
+	periodically. Settings come from environment variables:
+	 • `REDIS_SOCKET_TIMEOUT`: Seconds to wait on a Redis command before failing (default 2)
+	 • `REDIS_CONNECT_TIMEOUT`: Seconds to wait for a new Redis connection (default 2)
+	 • `REDIS_MAX_CONNECTIONS`: Size of the Redis connection pool (default 10)
+	 • `DB_POOL_SIZE`: Size of the MySQL connection pool (default 2)
+	 • `FACT_REFRESH_INTERVAL`: Seconds between checks for new facts (default 300)
+	 • `FACT_SNAPSHOT_PATH`: Local SQLite copy of the facts, written after each load and booted from
+	   so startup (and MySQL outages) don't wait on the database (default data/facts.sqlite3, `off` to disable)
+	 • `REDIS_DEADLINE`: Seconds any one Redis call may take, however it's spent (default 2)
+	 • `DB_CONNECT_TIMEOUT`: Seconds to wait for a new MySQL connection (default 5)
+	 • `DB_DEADLINE`: Seconds any one MySQL load may take (default 10)
+	 • `DB_IO_TIMEOUT`: Seconds a MySQL read or write may block (default 10)
+	 • `DB_RETRIES`: Extra attempts for a failed MySQL load, after jittered backoff (default 2, none after a missed deadline)
+
+	Calls to each backend go through a CircuitBreaker (see circuitbreaker.py for its settings), so once
+	one is down requests fail fast to the fallbacks below until a background probe finds it back.
+
+	Each process also keeps its own copy of today's counts and recent facts. Users it knows are over the
+	limit are answered without asking Redis, and while Redis is unavailable facts are served with these
+	best-effort limits, with the counts added to Redis once it's back.
+	"""
 	facts = None
+	fact_ids = None
+	last_id = 0
+	db_pool = None
+
+	# Facts came from the local snapshot and haven't been checked against MySQL yet
+	from_snapshot = False
+
 	redis_conn = None
+	fact_script = None
+	sync_script = None
+
+	# Whether this process has filled the shared fresh facts set from its fact table
+	fresh_synced = False
+
+	# Background tasks: the current full load (shared by requests arriving during it) and the refresh loop
+	load_task = None
+	refresh_task = None
 
 	DAILY_MAX = 5
 	RECENT_IDS_SIZE = 50
 
-	def populate_facts(self):
-		"""Connect to db and populate facts dict class variable"""
-		config = {
-			'user': os.environ['DB_USER'],
-			'password': os.environ['DB_PASSWORD'],
-			'host': os.environ['DB_HOST'],
-			'database': os.environ['DB_NAME']
-		}
+	LIMIT_MESSAGE = "*Pojo has given you, specifically, too many facts today and must rest. Inquire again tomorrow.*"
 
-		try:
-			conn = mysql.connector.connect(**config)
-			cursor = conn.cursor()
+	# Local tier: today's quota key, last known count per user, counts not yet added to Redis, and recent facts
+	local_day = None
+	local_counts = {}
+	pending_counts = {}
+	local_recent = deque(maxlen=RECENT_IDS_SIZE)
+
+	# Redis calls aren't retried: the fact script and count updates aren't safe to repeat.
+	# MySQL calls aren't retried after a missed deadline: the abandoned thread still holds its pooled connection.
+	redis_breaker = CircuitBreaker((RedisError,), float(os.environ.get('REDIS_DEADLINE', 2)), probe=probe_redis)
+	db_breaker = CircuitBreaker((DatabaseError,), float(os.environ.get('DB_DEADLINE', 10)), retries=int(os.environ.get('DB_RETRIES', 2)), probe=probe_db, retry_deadlines=False)
+
+	def get_db_pool(self):
+		"""Set MySQL connection pool to class variable and return it (connects, so call from a thread)"""
+		if FactService.db_pool is None:
+			config = {
+				'user': os.environ['DB_USER'],
+				'password': os.environ['DB_PASSWORD'],
+				'host': os.environ['DB_HOST'],
+				'database': os.environ['DB_NAME'],
+				'connection_timeout': int(os.environ.get('DB_CONNECT_TIMEOUT', 5)),
+
+				# Threads abandoned at their deadline can't be cancelled, so make their reads/writes give up too (and return the connection)
+				'read_timeout': int(os.environ.get('DB_IO_TIMEOUT', 10)),
+				'write_timeout': int(os.environ.get('DB_IO_TIMEOUT', 10))
+			}
 
-			query = "select id, message from pojofacts"
-			cursor.execute(query)
-			FactService.facts = {id_: message for id_, message in cursor}
+			pool_size = int(os.environ.get('DB_POOL_SIZE', 2))
+			FactService.db_pool = pooling.MySQLConnectionPool(pool_name='pojofacts', pool_size=pool_size, **config)
+		return FactService.db_pool
+
+	def query_facts(self, after_id=0):
+		"""Return list of (id, message) for facts with id above after_id, oldest first (blocking, so call from a thread)"""
+		try:
+			conn = self.get_db_pool().get_connection()
+			try:
+				cursor = conn.cursor()
+				cursor.execute("select id, message from pojofacts where id > %s order by id", (after_id,))
+				rows = cursor.fetchall()
+				cursor.close()
+			finally:
+				# Hands the connection back to the pool
+				conn.close()
+			return rows
+		except (mysql.connector.Error, IOError) as e:
+			raise DatabaseError()
 
-			cursor.close()
-			conn.close()
+	def ping_db(self):
+		"""Check a pooled MySQL connection works (blocking, so call from a thread)"""
+		try:
+			conn = self.get_db_pool().get_connection()
+			try:
+				conn.ping()
+			finally:
+				conn.close()
 		except (mysql.connector.Error, IOError) as e:
 			raise DatabaseError()
 
+	async def call_db(self, func, *args):
+		"""Run blocking MySQL function in a worker thread through db_breaker (deadline, retries, fail fast while MySQL is down)"""
+		return await FactService.db_breaker.call(asyncio.to_thread, func, *args)
+
+	async def call_redis(self, func, *args, retry=False):
+		"""Await Redis coroutine function through redis_breaker (deadline, fail fast while Redis is down)"""
+		return await FactService.redis_breaker.call(func, *args, retry=retry)
+
+	def set_facts(self, rows):
+		"""Replace facts dict class variable with (id, message) rows"""
+		FactService.facts = dict(rows)
+		FactService.fact_ids = tuple(FactService.facts.keys())
+		FactService.last_id = max(FactService.fact_ids, default=0)
+		FactService.fresh_synced = False
+
+	def populate_facts(self):
+		"""Load every fact from MySQL into facts dict class variable and snapshot them"""
+		self.set_facts(self.query_facts())
+		FactService.from_snapshot = False
+		self.write_snapshot()
+
+	def get_snapshot_path(self):
+		"""Return path of local facts snapshot, or None if disabled"""
+		path = os.environ.get('FACT_SNAPSHOT_PATH', os.path.join(os.path.dirname(__file__), "data", "facts.sqlite3"))
+		return None if path.lower() == 'off' else path
+
+	def read_snapshot(self):
+		"""Return list of (id, message) rows from local snapshot, or None if there isn't a readable one"""
+		path = self.get_snapshot_path()
+		if path is None or not os.path.exists(path):
+			return None
+
+		try:
+			conn = sqlite3.connect(path)
+			try:
+				return conn.execute("select id, message from facts order by id").fetchall()
+			finally:
+				conn.close()
+		except sqlite3.Error:
+			return None
+
+	def write_snapshot(self):
+		"""Save facts to local snapshot, building a new file and swapping it in so readers never see a partial one"""
+		path = self.get_snapshot_path()
+		if path is None:
+			return
+
+		temp_path = f"{path}.{os.getpid()}.tmp"
+		try:
+			os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+			if os.path.exists(temp_path):
+				os.remove(temp_path)
+
+			conn = sqlite3.connect(temp_path)
+			try:
+				with conn:
+					conn.execute("create table facts (id integer primary key, message text not null)")
+					conn.executemany("insert into facts values (?, ?)", FactService.facts.items())
+			finally:
+				conn.close()
+
+			os.replace(temp_path, path)
+		except (sqlite3.Error, OSError):
+			# The snapshot is only a head start for the next boot, so carry on without it
+			pass
+
+	async def boot_facts(self):
+		"""Load facts from local snapshot if there is one (MySQL takes over on the next refresh), otherwise from MySQL"""
+		rows = await asyncio.to_thread(self.read_snapshot)
+		if rows:
+			self.set_facts(rows)
+			FactService.from_snapshot = True
+		else:
+			await self.call_db(self.populate_facts)
+
+	def add_new_facts(self):
+		"""Load facts added since the last load into facts dict class variable, returning their ids"""
+		rows = self.query_facts(FactService.last_id)
+		if len(rows) > 0:
+			# New dict rather than updating in place, so requests never see a half-updated one
+			facts = dict(FactService.facts)
+			facts.update(rows)
+			FactService.facts = facts
+			FactService.fact_ids = tuple(facts.keys())
+			FactService.last_id = max(id_ for id_, message in rows)
+			self.write_snapshot()
+		return [id_ for id_, message in rows]
+
+	async def load_facts(self):
+		"""Load facts in a worker thread, sharing one load between requests that arrive during it"""
+		if FactService.load_task is None or (FactService.load_task.done() and FactService.facts is None):
+			FactService.load_task = asyncio.create_task(self.boot_facts())
+		await asyncio.shield(FactService.load_task)
+
+	async def refresh_facts(self):
+		"""Load facts if needed, swap snapshot facts for MySQL's, otherwise fetch only new ones and mark them fresh"""
+		if FactService.facts is None:
+			await self.load_facts()
+
+		# The snapshot may be missing edits and deletions, not just new rows, so reload it whole
+		if FactService.from_snapshot:
+			await self.call_db(self.populate_facts)
+		else:
+			new_ids = await self.call_db(self.add_new_facts)
+			if len(new_ids) > 0 and FactService.fresh_synced:
+				await self.call_redis(self.get_redis_conn().sadd, 'freshfacts', *new_ids)
+
+		if not FactService.fresh_synced:
+			await self.sync_fresh_ids()
+
+	async def refresh_periodically(self):
+		"""Refresh facts every FACT_REFRESH_INTERVAL seconds, forever"""
+		interval = float(os.environ.get('FACT_REFRESH_INTERVAL', 300))
+		while True:
+			try:
+				await self.refresh_facts()
+			except (DatabaseError, RedisError, circuitbreaker.Error):
+				# Try again next time (requests still load facts themselves if they have to)
+				pass
+			await asyncio.sleep(interval)
+
+	def start_background_loading(self):
+		"""Start loading and refreshing facts in the background, if a database is configured (call once the event loop is running)"""
+		if 'DB_HOST' not in os.environ:
+			return
+
+		if FactService.refresh_task is None or FactService.refresh_task.done():
+			FactService.refresh_task = asyncio.create_task(self.refresh_periodically())
+
 	def get_redis_conn(self):
-		"""Set Redis connection to class variable and return it"""
+		"""Set pooled async Redis client to class variable and return it"""
 		if FactService.redis_conn is None:
+			options = {
+				'decode_responses': True,
+				'socket_timeout': float(os.environ.get('REDIS_SOCKET_TIMEOUT', 2)),
+				'socket_connect_timeout': float(os.environ.get('REDIS_CONNECT_TIMEOUT', 2)),
+				'max_connections': int(os.environ.get('REDIS_MAX_CONNECTIONS', 10))
+			}
+
+			pool = None
 			environment = os.environ['ENVIRONMENT']
 			if environment == 'testing':
 				config = {
 					'host': os.environ['REDIS_HOST'],
 					'port': os.environ['REDIS_PORT'],
-					'db': os.environ['REDIS_DB'],
-					'decode_responses': True
+					'db': os.environ['REDIS_DB']
 				}
 
-				FactService.redis_conn = redis.Redis(**config)
+				pool = redis.ConnectionPool(**config, **options)
 
 			if environment == 'production':
 				url = os.environ['REDIS_URL']
-				FactService.redis_conn = redis.from_url(url, db=0, decode_responses=True)
+				pool = redis.ConnectionPool.from_url(url, db=0, **options)
+
+			if pool is not None:
+				FactService.redis_conn = redis.Redis(connection_pool=pool)
 		return FactService.redis_conn
 
-	def increment_user_tries(self, user_id):
-		"""Increment user's daily request count, set expiration if first, and return count"""
-		r = self.get_redis_conn()
-		key = f"user:{user_id}"
-		r.incr(key)
-		r.expireat(key, self.get_next_midnight(), nx=True)
-		return int(r.get(key))
+	def get_fact_script(self):
+		"""Register FACT_SCRIPT once (sent by hash after the first call) and return it"""
+		if FactService.fact_script is None:
+			FactService.fact_script = self.get_redis_conn().register_script(FACT_SCRIPT)
+		return FactService.fact_script
+
+	async def sync_fresh_ids(self):
+		"""Rebuild shared fresh facts set from this process's fact ids (once per load, O(facts))"""
+		if FactService.sync_script is None:
+			FactService.sync_script = self.get_redis_conn().register_script(SYNC_SCRIPT)
+
+		await self.call_redis(partial(FactService.sync_script, keys=['recentfacts', 'freshfacts'], args=list(FactService.fact_ids)))
+		FactService.fresh_synced = True
+
+	async def request_fact(self, user_id, midnight):
+		"""Increment user's daily request count and, if not over the max, pick a fresh fact and add it to recently used. Returns (count, fact key or None)."""
+		result = await self.call_redis(partial(
+			self.get_fact_script(),
+			keys=[self.get_quota_key(midnight), 'recentfacts', 'freshfacts'],
+			args=[int(midnight.timestamp()), FactService.DAILY_MAX, FactService.RECENT_IDS_SIZE, user_id]
+		))
+
+		count = int(result[0])
+		key = int(result[1]) if len(result) > 1 else None
+		return count, key
 
 	def get_next_midnight(self):
 		"""Calculate next midnight from now, for Redis expiration"""
@@ -75,37 +382,102 @@ class FactService:
 		midnight = tomorrow.replace(hour=0, minute=0, second=0, microsecond=0)
 		return midnight
 
-	def get_random_key(self):
-		"""Get random key not in recently used"""
-		r = self.get_redis_conn()
-		recent_keys = [int(k) for k in r.lrange('recentfacts', 0, -1)]
-		all_keys = FactService.facts.keys()
-		fresh_keys = list(set(all_keys) - set(recent_keys))
-		return random.choice(fresh_keys)
+	def get_quota_key(self, midnight):
+		"""Return key of the hash holding today's request counts, given the next midnight"""
+		today = (midnight - timedelta(1)).date()
+		return f"facttries:{today.isoformat()}"
+
+	def start_local_day(self, quota_key):
+		"""Forget local counts from previous days (their Redis hash has expired too)"""
+		if FactService.local_day != quota_key:
+			FactService.local_day = quota_key
+			FactService.local_counts = {}
+			FactService.pending_counts = {}
+
+	def pick_local_fact(self):
+		"""Return random fact key not in this process's recent facts (a few tries, then settle), and add it to them"""
+		for attempt in range(10):
+			key = random.choice(FactService.fact_ids)
+			if key not in FactService.local_recent:
+				break
+
+		FactService.local_recent.append(key)
+		return key
+
+	def local_response(self, user_id):
+		"""Count request and pick fact without Redis, remembering the count to add to Redis later"""
+		count = FactService.local_counts.get(user_id, 0) + 1
+		FactService.local_counts[user_id] = count
+		FactService.pending_counts[user_id] = FactService.pending_counts.get(user_id, 0) + 1
+
+		if count > FactService.DAILY_MAX:
+			return FactService.LIMIT_MESSAGE
+		return FactService.facts[self.pick_local_fact()]
+
+	async def reconcile_counts(self, quota_key, midnight):
+		"""Add requests counted while Redis was unavailable to today's hash, in one round trip"""
+		pending = FactService.pending_counts
+		if len(pending) == 0:
+			return
 
-	def get_fact(self):
-		"""Return random fact, add it to recently used and truncate length"""
-		key = self.get_random_key()
+		# Taken before awaiting, so requests served meanwhile aren't lost or added twice
+		FactService.pending_counts = {}
+		try:
+			pipe = self.get_redis_conn().pipeline(transaction=False)
+			for user_id, count in pending.items():
+				pipe.hincrby(quota_key, user_id, count)
+			pipe.expireat(quota_key, int(midnight.timestamp()), nx=True)
+			results = await self.call_redis(pipe.execute)
+		except (RedisError, circuitbreaker.Error):
+			for user_id, count in pending.items():
+				FactService.pending_counts[user_id] = FactService.pending_counts.get(user_id, 0) + count
+			raise
+
+		# Other processes may have counted some of these users too
+		for user_id, count in zip(pending, results):
+			FactService.local_counts[user_id] = max(FactService.local_counts.get(user_id, 0), int(count))
+
+	async def redis_response(self, user_id, quota_key, midnight):
+		"""Count request and pick fact through Redis. Raises RedisError or circuitbreaker.Error."""
+		if not FactService.fresh_synced:
+			await self.sync_fresh_ids()
+
+		await self.reconcile_counts(quota_key, midnight)
+
+		# Increment count and pick a fact in one round trip (if above max, return message)
+		count, key = await self.request_fact(user_id, midnight)
+		FactService.local_counts[user_id] = count
+		if count > FactService.DAILY_MAX:
+			return FactService.LIMIT_MESSAGE
 
-		# Add to recently used IDs
-		r = self.get_redis_conn()
-		r.lpush('recentfacts', key)
-		r.ltrim('recentfacts', 0, FactService.RECENT_IDS_SIZE-1)
+		# Redis lost the sets (e.g. restarted), or another process knows facts this one doesn't yet
+		if key not in FactService.facts:
+			if key is None:
+				await self.sync_fresh_ids()
+			key = random.choice(FactService.fact_ids)
 
+		FactService.local_recent.append(key)
 		return FactService.facts[key]
 
-	def response(self, user_id):
+	async def response(self, user_id):
 		try:
-			# Populate facts dict if empty
+			# Populate facts dict if the background load hasn't yet (or failed)
 			if FactService.facts is None:
-				self.populate_facts()
+				await self.load_facts()
+		except (DatabaseError, circuitbreaker.Error):
+			return "`Database error. Alert the admin and/or the president.`"
 
-			# Increment and check count (if above max, return message)
-			if self.increment_user_tries(user_id) > FactService.DAILY_MAX:
-				return "*Pojo has given you, specifically, too many facts today and must rest. Inquire again tomorrow.*"
+		midnight = self.get_next_midnight()
+		quota_key = self.get_quota_key(midnight)
+		self.start_local_day(quota_key)
 
-			# Get value, add key to recents
-			return self.get_fact()
-		except (DatabaseError, RedisError):
-			return "`Database error. Alert the admin and/or the president.`"
+		# Already known to be over the limit today, so no need to ask Redis
+		if FactService.local_counts.get(user_id, 0) >= FactService.DAILY_MAX:
+			return FactService.LIMIT_MESSAGE
+
+		try:
+			return await self.redis_response(user_id, quota_key, midnight)
+		except (RedisError, circuitbreaker.Error):
+			# Redis unavailable: best-effort limits from this process's own counts
+			return self.local_response(user_id)
 
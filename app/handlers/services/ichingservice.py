@@ -1,8 +1,10 @@
-from random import choice
-from itertools import product
+from random import choices
+from itertools import product, accumulate
 from enum import Enum
-import json
+from collections import namedtuple
 import os
+import numpy as np
+from app.handlers.services.dataindex import DataIndex
 
 '''
 GENERAL NOTE: In I Ching castings, lines are counted bottom-up, and that is
@@ -14,6 +16,11 @@ YIN
 
 Will be stored as [YIN, YANG, YANG]. Everything will follow this order except
 for printing the hexagram itself.
+
+A whole casting is stored as one 12-bit integer: bits 0-5 are the yin mask
+(bit 0 = bottom line, 1 = yin) and bits 6-11 are the changing ("old") mask in
+the same order. So the hexagram id is a table lookup on the low 6 bits, and
+the relating casting is just the yin mask XOR the changing mask.
 '''
 
 # CLASSES
@@ -34,6 +41,14 @@ class Lines:
 	YIN = Line(name='Yin', num=8, old=False, yin=True, probability=7)
 	OLDYANG = Line(name='Old Yang', num=9, old=True, yin=False, probability=3)
 
+# Bit layout of a casting integer
+YIN_BITS = 0b111111
+CHANGING_SHIFT = 6
+CASTING_COUNT = 1 << 12
+
+# Castings allowed per ))iching stats report
+MAX_STATS_CASTINGS = 1000000
+
 class Trigrams(Enum):
 	"""An actual enumerator for all 8 trigrams"""
 	HEAVEN = 1
@@ -45,175 +60,227 @@ class Trigrams(Enum):
 	MOUNTAIN = 7
 	EARTH = 8
 
+# TABLE BUILDERS (run once, when IChingService is defined)
+
+def build_hexagram_table(trigrams, hexagrams):
+	"""Return tuple of 64 hexagram ids indexed by yin mask"""
+	table = []
+	for yin_mask in range(64):
+		yin_bools = tuple(bool(yin_mask >> i & 1) for i in range(6))
+		table.append(hexagrams[(trigrams[yin_bools[:3]], trigrams[yin_bools[3:]])])
+	return tuple(table)
+
+def build_cumulative_weights(line_types):
+	"""Return cumulative weights of all 4096 casting integers (product of each line's probability)"""
+	weights = []
+	for casting in range(CASTING_COUNT):
+		weight = 1
+		for i in range(6):
+			line = line_types[(casting >> i & 1, casting >> (CHANGING_SHIFT + i) & 1)]
+			weight *= line.probability
+		weights.append(weight)
+	return list(accumulate(weights))
+
+# Immutable record for a hexagram's entry in data/iching/iching.json
+Hexagram = namedtuple('Hexagram', ['id', 'character', 'title', 'description', 'judgement', 'image', 'lines'])
+
+# A hexagram's pieces of response text, rendered once per data load
+HexagramText = namedtuple('HexagramText', ['header', 'relating_header', 'body', 'lines', 'link'])
+
 class IChingService:
-	def __init__(self):
-		"""Sets up dictionaries for later methods"""
-		# Trigrams
-		yin = True
-		yang = False
-		self.trigrams = {
-			(yang, yang, yang): Trigrams.HEAVEN,
-			(yang, yang, yin): Trigrams.LAKE,
-			(yang, yin, yang): Trigrams.FIRE,
-			(yang, yin, yin): Trigrams.THUNDER,
-			(yin, yang, yang): Trigrams.WIND,
-			(yin, yang, yin): Trigrams.WATER,
-			(yin, yin, yang): Trigrams.MOUNTAIN,
-			(yin, yin, yin): Trigrams.EARTH
-		}
-
-		# Hexagrams
-		trigram_pairs = product(Trigrams, repeat=2)
-
-		# See https://goo.gl/DNsvds
-		hexagram_ids = [
-			1, 43, 14, 34, 9, 5, 26, 11,
-			10, 58, 38, 54, 61, 60, 41, 19,
-			13, 49, 30, 55, 37, 63, 22, 36,
-			25, 17, 21, 51, 42, 3, 27, 24,
-			44, 28, 50, 32, 57, 48, 18, 46,
-			6, 47, 64, 40, 59, 29, 4, 7,
-			33, 31, 56, 62, 53, 39, 52, 15,
-			12, 45, 35, 16, 20, 8, 23, 2
-		]
-
-		# Make dict {trigram combination: id}
-		self.hexagrams = dict(zip(trigram_pairs, hexagram_ids))
-
-	def cast_lines(self):
-		"""Return initial casting (a list of 6 random Lines)"""
-		# Simulate weighted probabilities by multiplying each list item by its probability
-		probabilities = [Lines.OLDYIN] * Lines.OLDYIN.probability
-		probabilities += [Lines.YANG] * Lines.YANG.probability
-		probabilities += [Lines.YIN] * Lines.YIN.probability
-		probabilities += [Lines.OLDYANG] * Lines.OLDYANG.probability
-
-		casting = [choice(probabilities) for _ in range(6)]
-		return casting
-
-	def get_trigrams(self, casting):
-		"""Return tuple of bottom and top trigram for use as dictionary keys"""
-		# Deal only with booleans if yin or not
-		yin_bools = tuple([line.yin for line in casting])
-
-		bottom_trigram = self.trigrams[yin_bools[:3]]
-		top_trigram = self.trigrams[yin_bools[3:]]
-
-		return bottom_trigram, top_trigram
-
-	def get_hexagram_id(self, bottom_trigram, top_trigram):
-		"""Return id (starting at 1) for hexagram based on bottom and top trigram"""
-		hexagram_id = self.hexagrams[(bottom_trigram, top_trigram)]
-		return hexagram_id
+	# Hexagram texts, parsed once per process
+	data_index = DataIndex(
+		os.path.join(os.path.dirname(__file__), "data", "iching", "iching.json"),
+		Hexagram
+	)
+
+	# Trigrams (keys are yin booleans, bottom line first)
+	trigrams = {
+		(False, False, False): Trigrams.HEAVEN,
+		(False, False, True): Trigrams.LAKE,
+		(False, True, False): Trigrams.FIRE,
+		(False, True, True): Trigrams.THUNDER,
+		(True, False, False): Trigrams.WIND,
+		(True, False, True): Trigrams.WATER,
+		(True, True, False): Trigrams.MOUNTAIN,
+		(True, True, True): Trigrams.EARTH
+	}
+
+	# Hexagrams as dict {trigram combination: id}. See https://goo.gl/DNsvds
+	hexagrams = dict(zip(product(Trigrams, repeat=2), [
+		1, 43, 14, 34, 9, 5, 26, 11,
+		10, 58, 38, 54, 61, 60, 41, 19,
+		13, 49, 30, 55, 37, 63, 22, 36,
+		25, 17, 21, 51, 42, 3, 27, 24,
+		44, 28, 50, 32, 57, 48, 18, 46,
+		6, 47, 64, 40, 59, 29, 4, 7,
+		33, 31, 56, 62, 53, 39, 52, 15,
+		12, 45, 35, 16, 20, 8, 23, 2
+	]))
+
+	# Every Line by its (yin, changing) bits
+	line_types = {(int(line.yin), int(line.old)): line for line in (Lines.OLDYIN, Lines.YANG, Lines.YIN, Lines.OLDYANG)}
+
+	# Hexagram ids indexed by yin mask, and sampling weights indexed by casting integer
+	hexagram_table = build_hexagram_table(trigrams, hexagrams)
+	cumulative_weights = build_cumulative_weights(line_types)
+	cumulative_weights_array = np.array(cumulative_weights, dtype=np.int64)
+
+	# Discord strings for each Line (with newline, ready to join)
+	line_glyphs = {
+		Lines.OLDYIN: "~~　　　~~╳~~　　　~~\n",
+		Lines.YANG: "~~　　　　　　　~~\n",
+		Lines.YIN: "~~　　　~~　~~　　　~~\n",
+		Lines.OLDYANG: "~~　　　◯　　　~~\n"
+	}
+
+	# Tuple of (index it was rendered from, {id: HexagramText}), rebuilt if the data index reloads
+	texts = (None, None)
+
+	def cast(self):
+		"""Return a random casting integer (one weighted draw over all 4096 castings)"""
+		return choices(range(CASTING_COUNT), cum_weights=IChingService.cumulative_weights)[0]
+
+	def cast_batch(self, n):
+		"""Return NumPy array of n random casting integers, drawn in one vectorized pass"""
+		total = IChingService.cumulative_weights[-1]
+		draws = np.random.default_rng().integers(0, total, size=n)
+		return np.searchsorted(IChingService.cumulative_weights_array, draws, side='right')
+
+	def get_hexagram_id(self, casting):
+		"""Return id (starting at 1) for a casting's hexagram"""
+		return IChingService.hexagram_table[casting & YIN_BITS]
 
 	def get_relating_casting(self, casting):
-		"""Convert old lines to their opposite and return casting (list of 6 Lines)"""
-		# Change old yang to yin
-		casting = [Lines.YIN if line is Lines.OLDYANG else line for line in casting]
-
-		# Change old yin to yang
-		casting = [Lines.YANG if line is Lines.OLDYIN else line for line in casting]
+		"""Flip changing lines to their opposite and return casting with no changing lines"""
+		return (casting ^ (casting >> CHANGING_SHIFT)) & YIN_BITS
 
-		return casting
+	def get_lines(self, casting):
+		"""Return casting as list of 6 Lines (bottom first)"""
+		return [IChingService.line_types[(casting >> i & 1, casting >> (CHANGING_SHIFT + i) & 1)] for i in range(6)]
 
 	def line_repr(self, line):
 		"""Get string to display a Line on Discord"""
-		if line is Lines.OLDYIN:
-			return "~~　　　~~╳~~　　　~~"
-		if line is Lines.YANG:
-			return "~~　　　　　　　~~"
-		if line is Lines.YIN:
-			return "~~　　　~~　~~　　　~~"
-		if line is Lines.OLDYANG:
-			return "~~　　　◯　　　~~"
+		return IChingService.line_glyphs[line][:-1]
+
+	def casting_repr(self, casting):
+		"""Get string to display a whole casting on Discord (reversed to be top-down)"""
+		return ''.join([IChingService.line_glyphs[line] for line in self.get_lines(casting)[::-1]])
 
 	def get_changing_line_numbers(self, casting):
 		"""Get indexes where there is a changing line (starting at 1)"""
-		return [i for i, line in enumerate(casting, start=1) if line in [Lines.OLDYIN, Lines.OLDYANG]]
+		changing = casting >> CHANGING_SHIFT
+		return [i + 1 for i in range(6) if changing >> i & 1]
 
 	def load_data(self):
-		"""Load JSON from data/iching/iching.json into dict"""
-		# Won't work if ever in distribution. Convert to use pkg_resources?
-		this_directory, this_filename = os.path.split(__file__)
-		data_filepath = os.path.join(this_directory, "data", "iching", "iching.json")
+		"""Return read-only {id: Hexagram} index of data/iching/iching.json (shared, parsed once)"""
+		return IChingService.data_index.get()
+
+	def render_text(self, hexagram):
+		"""Render every fixed piece of response text for a Hexagram"""
+		title = '{} — {}\n{}**\n\n'.format(hexagram.id, hexagram.character, hexagram.title)
+
+		return HexagramText(
+			header='**HEXAGRAM ' + title,
+			relating_header='**RELATING HEXAGRAM: HEXAGRAM ' + title,
+			body='**Judgement**\n```{}```\n**Image**\n```{}```\n'.format(hexagram.judgement, hexagram.image),
+			lines=tuple('Line {}:\n```{}```\n'.format(num, line) for num, line in enumerate(hexagram.lines, start=1)),
+			link='For commentary and interpretation:\nhttp://www.akirarabelais.com/i/i.html#{}'.format(hexagram.id)
+		)
+
+	def load_texts(self):
+		"""Return {id: HexagramText} for all hexagrams, rendering them only when the data is (re)loaded"""
+		data = self.load_data()
+		source, texts = IChingService.texts
 
-		with open(data_filepath, encoding='utf-8') as f:
-			data = json.load(f)
+		if source is not data:
+			texts = {hexagram_id: self.render_text(hexagram) for hexagram_id, hexagram in data.items()}
+			IChingService.texts = (data, texts)
 
-		return data
+		return texts
 
-	def response(self):
-		# Make initial casting
-		casting = self.cast_lines()
-		hexagram_id = self.get_hexagram_id(*self.get_trigrams(casting))
+	def render_response(self, casting):
+		"""Build response text for a casting integer"""
+		hexagram_id = self.get_hexagram_id(casting)
 
 		# Make relating casting
 		relating_casting = self.get_relating_casting(casting)
-		relating_hexagram_id = self.get_hexagram_id(*self.get_trigrams(relating_casting))
-
-		# Load full I Ching dictionary
-		data = self.load_data()
-
-		# Build response
-		response = ""
+		relating_hexagram_id = self.get_hexagram_id(relating_casting)
 
-		# Add title
-		response += '**HEXAGRAM {} — {}\n'.format(data[hexagram_id-1]['id'], data[hexagram_id-1]['character'])
-		response += data[hexagram_id-1]['title'] + '**\n\n'
+		# Get pre-rendered text for all hexagrams
+		texts = self.load_texts()
+		text = texts[hexagram_id]
 
-		# Add hexagram (reversed to be top-down)
-		for line in casting[::-1]:
-			response += self.line_repr(line) + '\n'
-		response += '\n'
-
-		# Add Judgement
-		response += '**Judgement**\n'
-		response += '```{}```\n'.format(data[hexagram_id-1]['judgement'])
-
-		# Add Image
-		response += '**Image**\n'
-		response += '```{}```\n'.format(data[hexagram_id-1]['image'])
-
-		# Make link text (don't add yet)
-		link = 'For commentary and interpretation:\n'
-		link += 'http://www.akirarabelais.com/i/i.html#{}'.format(hexagram_id)
+		# Build response from pieces: title, hexagram, then Judgement and Image
+		parts = [text.header, self.casting_repr(casting), '\n', text.body]
 
 		# Add changing lines and relating hexagram (if any changing lines)
 		changing_line_numbers = self.get_changing_line_numbers(casting)
 		if len(changing_line_numbers) > 0:
-			response += '**Changing Lines**\n'
 			number_list_str = ', '.join(str(num) for num in changing_line_numbers)
-			response += 'There are changing lines in lines: {} (numbered from the bottom)\n\n'.format(number_list_str)
-
-			for num in changing_line_numbers:
-				response += "Line {}:\n".format(num)
-				response += '```{}```\n'.format(data[hexagram_id-1]['lines'][num-1])
-
-			# Add commentary link
-			response += link + '\n\n'
-
-			# Add relating hexagram
-			response += '**RELATING HEXAGRAM: HEXAGRAM {} — {}\n'.format(data[relating_hexagram_id-1]['id'], data[relating_hexagram_id-1]['character'])
-			response += data[relating_hexagram_id-1]['title'] + '**\n\n'
+			parts.append('**Changing Lines**\nThere are changing lines in lines: {} (numbered from the bottom)\n\n'.format(number_list_str))
+			parts += [text.lines[num-1] for num in changing_line_numbers]
 
-			# Add hexagram (reversed to be top-down)
-			for line in relating_casting[::-1]:
-				response += self.line_repr(line) + '\n'
-			response += '\n'
-
-			# Add Judgement
-			response += '**Judgement**\n'
-			response += '```{}```\n'.format(data[relating_hexagram_id-1]['judgement'])
-
-			# Add Image
-			response += '**Image**\n'
-			response += '```{}```\n'.format(data[relating_hexagram_id-1]['image'])
-
-			# Add relating hexagram link
-			response += 'For commentary and interpretation:\n'
-			response += 'http://www.akirarabelais.com/i/i.html#{}'.format(relating_hexagram_id)
+			# Add commentary link, then relating hexagram with its own link
+			relating_text = texts[relating_hexagram_id]
+			parts += [text.link, '\n\n', relating_text.relating_header, self.casting_repr(relating_casting), '\n', relating_text.body, relating_text.link]
 		else:
 			# Add commentary link for sole hexagram (no changing lines)
-			response += link
+			parts.append(text.link)
 
-		return response
+		return ''.join(parts)
+
+	def response(self):
+		return self.render_response(self.cast())
+
+	def stats_response(self, n):
+		"""Cast n times at once and return a distribution report comparing observed and expected frequencies"""
+		castings = self.cast_batch(n)
+		yin_masks = castings & YIN_BITS
+		changing_masks = castings >> CHANGING_SHIFT
+
+		# Count each line type over all 6n lines
+		bits = np.arange(6)
+		yin_bits = (yin_masks[:, None] >> bits) & 1
+		changing_bits = (changing_masks[:, None] >> bits) & 1
+		line_counts = np.bincount((yin_bits * 2 + changing_bits).ravel(), minlength=4)
+
+		# Hexagram ids for primary and relating castings
+		table = np.array(IChingService.hexagram_table)
+		hexagram_counts = np.bincount(table[yin_masks], minlength=65)[1:]
+		relating_counts = np.bincount(table[yin_masks ^ changing_masks], minlength=65)[1:]
+
+		changing_per_casting = changing_bits.sum(axis=1)
+		total_weight = sum(line.probability for line in IChingService.line_types.values())
+
+		lines = ['I Ching distribution over {:,} castings'.format(n), '']
+
+		lines.append('Line types (observed / expected)')
+		for (yin, changing), line in sorted(IChingService.line_types.items(), key=lambda item: item[1].num):
+			observed = line_counts[yin * 2 + changing] / (6 * n)
+			lines.append(' {:<9} {:>7.2%} / {:>6.2%}'.format(line.name, observed, line.probability / total_weight))
+
+		# Stable lines are YANG (5) and YIN (7) of every 16
+		stable = (Lines.YANG.probability + Lines.YIN.probability) / total_weight
+		lines.append('')
+		lines.append('Changing lines per casting: {:.3f} (expected {:.3f})'.format(changing_per_casting.mean(), 6 * (1 - stable)))
+		lines.append('No changing lines: {:.2%} (expected {:.2%})'.format((changing_per_casting == 0).mean(), stable ** 6))
+
+		for name, counts in [('Hexagrams', hexagram_counts), ('Relating hexagrams', relating_counts)]:
+			order = np.argsort(counts)
+			most = ', '.join('#{} {:.2%}'.format(i + 1, counts[i] / n) for i in order[::-1][:3])
+			least = ', '.join('#{} {:.2%}'.format(i + 1, counts[i] / n) for i in order[:3])
+			lines.append('')
+			lines.append('{} (uniform would be {:.2%})'.format(name, 1 / 64))
+			lines.append(' Most common:  ' + most)
+			lines.append(' Least common: ' + least)
+
+		return '```' + '\n'.join(lines) + '```'
+
+
+# JOBS
+# Module-level so a RenderExecutor can run them in worker processes
+
+def stats_report(n):
+	"""Return IChingService distribution report for n castings"""
+	return IChingService().stats_response(n)
@@ -0,0 +1,97 @@
+import os
+from io import BytesIO
+from PIL import Image
+
+# ERRORS
+
+class Error(Exception):
+	"""Generic error to extend"""
+	pass
+
+class FormatNotSupportedError(Error):
+	"""The requested output format isn't one the encoder knows."""
+	pass
+
+
+# CLASS
+
+class ImageEncoder:
+	"""Encodes PIL images for upload, stepping down quality and then resolution until the result fits max_bytes.
+
+	Settings come from arguments or environment variables:
+	 • `IMAGE_FORMAT`: `jpeg` [default], `webp` or `png`
+	 • `IMAGE_QUALITY`: Starting quality for lossy formats, 1-100 (default 85)
+	 • `IMAGE_MAX_BYTES`: Upload size to fit under (default 8 MiB, Discord's smallest upload limit)
+	"""
+	# Format: (PIL format name, file extension, lossy, image modes it can save without converting)
+	FORMATS = {
+		'webp': ('WEBP', 'webp', True, ('RGB', 'RGBX')),
+		'jpeg': ('JPEG', 'jpg', True, ('RGB', 'RGBX', 'L')),
+		'png': ('PNG', 'png', False, ('RGB', 'L'))
+	}
+
+	# Lowest quality tried before shrinking the image instead
+	MIN_QUALITY = 50
+	QUALITY_STEP = 10
+
+	# Each resolution step scales both sides by this much
+	SCALE_STEP = 0.75
+	MAX_SCALE_STEPS = 6
+
+	def __init__(self, format=None, quality=None, max_bytes=None):
+		self.format = (format or os.environ.get('IMAGE_FORMAT', 'jpeg')).lower()
+		self.quality = quality or int(os.environ.get('IMAGE_QUALITY', 85))
+		self.max_bytes = max_bytes or int(os.environ.get('IMAGE_MAX_BYTES', 8 * 1024 * 1024))
+
+		if self.format not in ImageEncoder.FORMATS:
+			raise FormatNotSupportedError()
+
+	@property
+	def extension(self):
+		"""File extension for this encoder's output (e.g. for upload filenames)"""
+		return ImageEncoder.FORMATS[self.format][1]
+
+	def settings(self):
+		"""Tuple of everything that affects this encoder's output (e.g. for cache keys)"""
+		return (self.format, self.quality, self.max_bytes)
+
+	def encode_once(self, image, quality):
+		"""Return bytes of image encoded once at given quality"""
+		pil_format, extension, lossy, modes = ImageEncoder.FORMATS[self.format]
+
+		# Spreads have no transparency worth keeping, and JPEG can't store it anyway
+		if image.mode not in modes:
+			image = image.convert('RGB')
+
+		options = {'quality': quality} if lossy else {'optimize': True}
+		if self.format == 'webp':
+			# Faster compression method (default is 4 of 0-6); size difference is small for photos
+			options['method'] = 3
+
+		buffer = BytesIO()
+		image.save(buffer, pil_format, **options)
+		return buffer.getvalue()
+
+	def encode(self, image):
+		"""Return bytes of image in this encoder's format, reduced in quality then size as needed to fit max_bytes"""
+		lossy = ImageEncoder.FORMATS[self.format][2]
+
+		for step in range(ImageEncoder.MAX_SCALE_STEPS + 1):
+			if step > 0:
+				width, height = image.size
+				size = (max(1, int(width * ImageEncoder.SCALE_STEP)), max(1, int(height * ImageEncoder.SCALE_STEP)))
+				image = image.resize(size, Image.Resampling.BILINEAR)
+
+			# Try each quality level (just the one pass for lossless formats)
+			quality = self.quality
+			while True:
+				data = self.encode_once(image, quality)
+				if len(data) <= self.max_bytes:
+					return data
+
+				quality -= ImageEncoder.QUALITY_STEP
+				if not lossy or quality < ImageEncoder.MIN_QUALITY:
+					break
+
+		# Still too big after every step: send smallest attempt and let the upload decide
+		return data
@@ -2,6 +2,13 @@ import os
 from PIL import Image
 import random
 import json
+import hashlib
+import mmap
+import struct
+import threading
+from collections import namedtuple
+from app.handlers.services.dataindex import DataIndex
+from app.handlers.services.bytecache import ByteLimitedCache
 
 # ERRORS
 
@@ -17,11 +24,37 @@ class SpreadNotFoundError(Error):
 	"""The spread name provided is not supported."""
 	pass
 
+class ResolutionNotFoundError(Error):
+	"""The resolution name provided is not supported."""
+	pass
+
 class BadTypeError(Error):
 	"""The provided argument is not the expected type. (Often a non-boolean instead of a boolean.)"""
 	pass
 
 
+# CONSTANTS
+
+# Fills gaps between cards. Spreads are opaque so no alpha channel is needed;
+# this is close to Discord's dark theme so the gaps still blend in.
+BACKGROUND_COLOR = (49, 51, 56)
+
+# Counterclockwise degrees (like Image.rotate()) to lossless transposes
+ROTATIONS = {
+	90: Image.Transpose.ROTATE_90,
+	180: Image.Transpose.ROTATE_180,
+	270: Image.Transpose.ROTATE_270
+}
+
+
+# Card widths in pixels for each resolution tier (None keeps the source JPEG's size)
+RESOLUTIONS = {
+	'full': None,
+	'preview': 200,
+	'thumbnail': 100
+}
+
+
 # DECORATORS
 
 def card_count(i):
@@ -31,24 +64,203 @@ def card_count(i):
 		return func
 	return decorator
 
+def render_cached(func):
+	"""Marks spreads with few enough possible outcomes that their encoded images are worth caching (when cached, they get cards without images, so may only pass card images through)"""
+	func.render_cached = True
+	return func
+
+def default_resolution(resolution):
+	"""Sets resolution tier each spread uses when none is requested (big spreads composite from smaller cards)"""
+	def decorator(func):
+		func.default_resolution = resolution
+		return func
+	return decorator
+
 
 # CLASSES
 
 class ResponseModel:
-	"""Holds a message and image (default=None) to return to the MessageHandler (instead of generic tuple)"""
-	def __init__(self, message, image=None):
+	"""Holds a message, image (default=None), key identifying the image's contents for caching (default=None), and already encoded image (default=None) to return to the MessageHandler (instead of generic tuple)"""
+	def __init__(self, message, image=None, render_key=None, image_bytes=None):
 		self.message = message
 		self.image = image
+		self.render_key = render_key
+		self.image_bytes = image_bytes
+
+class ImageCache(ByteLimitedCache):
+	"""Process-wide LRU cache of decoded PIL images, bounded by their total decoded size in bytes."""
+	@staticmethod
+	def image_bytes(image):
+		"""Approximate memory held by a decoded image (Pillow stores multi-band pixels in 4 bytes)"""
+		pixel_size = 1 if image.mode in ('1', 'L', 'P') else 4
+		return image.width * image.height * pixel_size
+
+	def size_of(self, image):
+		return self.image_bytes(image)
+
+class RenderCache(ByteLimitedCache):
+	"""LRU cache of final encoded spread images, with an optional directory of files as a second tier that survives restarts (and is shared by worker processes)."""
+	def __init__(self, max_bytes, directory=None):
+		super().__init__(max_bytes)
+		self.directory = directory
+
+		# Counters for monitoring the disk tier (memory misses that were/weren't on disk)
+		self.disk_hits = 0
+		self.disk_misses = 0
+
+		if self.directory is not None:
+			os.makedirs(self.directory, exist_ok=True)
+
+	def disk_path(self, key):
+		"""Path of key's file in the disk tier (keys are tuples of plain values, so repr() is stable)"""
+		return os.path.join(self.directory, hashlib.sha1(repr(key).encode('utf-8')).hexdigest())
+
+	def get(self, key):
+		"""Return encoded bytes for key from memory, then disk (promoting to memory), or None if in neither"""
+		data = super().get(key)
+		if data is not None or self.directory is None:
+			return data
+
+		# Unreadable files (permissions, I/O errors) count as misses too
+		try:
+			with open(self.disk_path(key), 'rb') as f:
+				data = f.read()
+		except OSError:
+			self.disk_misses += 1
+			return None
+
+		self.disk_hits += 1
+		super().put(key, data)
+		return data
+
+	def put(self, key, data):
+		"""Cache encoded bytes under key in memory and (if enabled) on disk"""
+		super().put(key, data)
+
+		if self.directory is not None:
+			# Write beside the final path and swap in, so readers never see a partial file.
+			# Temp name is unique per process and thread, since renders of the same key can run at once.
+			path = self.disk_path(key)
+			temp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+			try:
+				with open(temp_path, 'wb') as f:
+					f.write(data)
+				os.replace(temp_path, path)
+			except OSError:
+				# Disk tier is best effort (full disk, permissions): the bytes are still cached in memory
+				try:
+					os.remove(temp_path)
+				except OSError:
+					pass
+
+	def stats(self):
+		stats = super().stats()
+		stats['disk_hits'] = self.disk_hits
+		stats['disk_misses'] = self.disk_misses
+		return stats
+
+class DeckAtlas:
+	"""A whole deck packed into one file of raw pixel tiles (built by tools/build_atlas.py) and memory-mapped.
+
+	Card images are zero-copy views into the mapping, so decks cost no decoding, and every process
+	mapping the same file shares one copy of it in the OS page cache.
+
+	Layout: MAGIC, little-endian uint32 index length, JSON index {"mode": ..., "tiles": {card_id: [offset, width, height]}},
+	then raw tile pixels from the next page boundary on (tile offsets are relative to it, each also page-aligned).
+	"""
+	MAGIC = b'POJOATL1'
+
+	# RGBX keeps Pillow's in-memory layout (4 bytes per pixel), which is what lets it map pixels without copying
+	MODE = 'RGBX'
+	PIXEL_SIZE = 4
+	ALIGNMENT = mmap.PAGESIZE
+
+	def __init__(self, path):
+		with open(path, 'rb') as f:
+			self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+		if self.map[:len(DeckAtlas.MAGIC)] != DeckAtlas.MAGIC:
+			raise ValueError('Not a deck atlas: ' + path)
+
+		index_start = len(DeckAtlas.MAGIC) + 4
+		index_length, = struct.unpack('<I', self.map[len(DeckAtlas.MAGIC):index_start])
+		index = json.loads(self.map[index_start:index_start + index_length])
+
+		self.mode = index['mode']
+		self.tiles = {int(card_id): tuple(tile) for card_id, tile in index['tiles'].items()}
+		self.data_start = DeckAtlas.align(index_start + index_length)
+
+	def image(self, card_id):
+		"""Return read-only PIL image viewing card_id's pixels in the mapped file"""
+		offset, width, height = self.tiles[card_id]
+		start = self.data_start + offset
+		view = memoryview(self.map)[start:start + width * height * DeckAtlas.PIXEL_SIZE]
+		return Image.frombuffer(self.mode, (width, height), view, 'raw', self.mode, 0, 1)
+
+	@staticmethod
+	def align(position):
+		"""Round position up to the next page boundary"""
+		return -(-position // DeckAtlas.ALIGNMENT) * DeckAtlas.ALIGNMENT
+
+	@staticmethod
+	def build(images, path):
+		"""Write atlas file to path from dict of {card_id: PIL image}"""
+		# Offsets are relative to the first page after the index, each tile on its own page boundary
+		tiles = {}
+		offset = 0
+		for card_id, image in images.items():
+			width, height = image.size
+			tiles[card_id] = [offset, width, height]
+			offset = DeckAtlas.align(offset + width * height * DeckAtlas.PIXEL_SIZE)
+
+		index = json.dumps({'mode': DeckAtlas.MODE, 'tiles': tiles}).encode('utf-8')
+
+		with open(path, 'wb') as f:
+			f.write(DeckAtlas.MAGIC)
+			f.write(struct.pack('<I', len(index)))
+			f.write(index)
+			data_start = DeckAtlas.align(f.tell())
+
+			for card_id, image in images.items():
+				f.write(b'\0' * (data_start + tiles[card_id][0] - f.tell()))
+				f.write(image.convert(DeckAtlas.MODE).tobytes())
+
+# Immutable record for a card's entry in data/tarot/tarot.json
+CardData = namedtuple('CardData', ['id', 'name', 'meaning', 'suit', 'number'])
 
 class Card:
-	"""Holds a card's ID (0-77), reversed boolean, description, and PIL image."""
-	def __init__(self, id, reversed, description, image):
+	"""Holds a card's ID (0-77), reversed boolean, description, PIL image, and the deck, rotation and resolution the image came from."""
+	def __init__(self, id, reversed, description, image, deck, rotation=0, resolution='full'):
 		self.id = id
 		self.reversed = reversed
 		self.description = description
 		self.image = image
+		self.deck = deck
+		self.rotation = rotation
+		self.resolution = resolution
 
 class TarotService:
+	# Decoded card images shared by all instances (one TarotService is made per message)
+	image_cache = ImageCache(int(os.environ.get('TAROT_CACHE_BYTES', 64 * 1024 * 1024)))
+
+	# Encoded images for @render_cached spreads, so repeat outcomes skip compositing and encoding
+	render_cache = RenderCache(
+		int(os.environ.get('TAROT_RENDER_CACHE_BYTES', 16 * 1024 * 1024)),
+		os.environ.get('TAROT_RENDER_CACHE_DIR')
+	)
+
+	# Memory-mapped DeckAtlas per (deck, resolution) (None if no atlas built), opened on first use
+	atlases = {}
+	atlases_lock = threading.Lock()
+
+	# Card names and meanings, parsed once per process
+	data_index = DataIndex(
+		os.path.join(os.path.dirname(__file__), "data", "tarot", "tarot.json"),
+		CardData
+	)
+
+	DEFAULT_DECK = 'rider-waite-smith'
+
 	def __init__(self):
 		"""Lists available avaiable decks and spreads for later methods"""
 		self.decks = [
@@ -64,12 +276,15 @@ class TarotService:
 
 	# SPREADS
 
+	@render_cached
+	@default_resolution('full')
 	@card_count(1)
 	def single(self, cards):
 		"""Makes a ResponseModel with the PIL image and text for a single-card spread."""
 		card = cards[0]
 		return ResponseModel(card.description, card.image)
 
+	@default_resolution('full')
 	@card_count(3)
 	def three_card(self, cards):
 		"""Makes a ResponseModel with the PIL image and text for a horizontal three-card spread."""
@@ -79,7 +294,8 @@ class TarotService:
 
 		output_width = card_width * len(cards) + padding * (len(cards) - 1)
 		output_height = card_height
-		output_img = Image.new('RGBA', (output_width, output_height), (0, 0, 0, 0))
+		# Match the cards' mode (RGBX for atlas decks) so pasting never has to convert
+		output_img = Image.new(cards[0].image.mode, (output_width, output_height), BACKGROUND_COLOR)
 
 		# Generate top-left corner points to place cards
 		x_points = [i * (card_width + padding) for i in range(len(cards))]
@@ -93,6 +309,7 @@ class TarotService:
 
 		return ResponseModel(message, output_img)
 
+	@default_resolution('preview')
 	@card_count(10)
 	def celtic_cross(self, cards):
 		"""Makes a ResponseModel with the large PIL image and text for a complex celtic cross spread."""
@@ -104,7 +321,8 @@ class TarotService:
 
 		output_height = card_height * 4 + column_padding * 3
 		output_width = card_width * 4 + cross_padding * 3
-		output_img = Image.new('RGBA', (output_width, output_height), (0, 0, 0, 0))
+		# Match the cards' mode (RGBX for atlas decks) so pasting never has to convert
+		output_img = Image.new(cards[0].image.mode, (output_width, output_height), BACKGROUND_COLOR)
 
 		# Build points to place cards
 		points = []
@@ -133,8 +351,10 @@ class TarotService:
 		points += [(x, y) for y in cross_ys]
 
 		# Card 4 (Turned center)
-		# Rotate image
-		cards[4].image = cards[4].image.rotate(270, expand=True)
+		# Swap in the turned variant of the image (cached, so no rotation per reading)
+		turned = cards[4]
+		turned.rotation = (turned.rotation + 270) % 360
+		turned.image = self.load_image(turned.deck, turned.id, turned.rotation, turned.resolution)
 		# Calculate coordinates from cross center coordinates
 		x, y = points[2]
 		dimension_difference = (card_height - card_width) // 2
@@ -196,8 +416,8 @@ class TarotService:
 
 	# BUILDING RANDOM CARDS
 
-	def draw_cards(self, amount, deck, reversals, pips):
-		"""Build list of desired amount of random Cards with attached id, reversed boolean, description, and image (flipped if reversed)."""
+	def draw_cards(self, amount, deck, reversals, pips, resolution='full', load_images=True):
+		"""Build list of desired amount of random Cards with attached id, reversed boolean, description, and image (flipped if reversed, or None until load_card_images() if not load_images)."""
 		# Grab all 78 cards or first 21 if 'pips' are included
 		upper_range = 79 if pips else 22
 
@@ -212,9 +432,9 @@ class TarotService:
 			# 25% reversed cards seems okay (always set to False if no reversals)
 			reversed = random.randrange(100) < 25 if reversals else False
 
-			# Build text description (subtract 1 because JSON 0-indexed)
-			name = '**' + data[card_id-1]['name'] + '**'
-			meaning = data[card_id-1]['meaning']
+			# Build text description
+			name = '**' + data[card_id].name + '**'
+			meaning = data[card_id].meaning
 
 			# Add reversal notes
 			if reversed:
@@ -223,77 +443,191 @@ class TarotService:
 
 			description = name + '\n' + meaning
 
-			# Get PIL image
-			image = self.load_image(deck, card_id)
+			# Add card to list (image pre-flipped 180 if reversed)
+			rotation = 180 if reversed else 0
+			cards.append(Card(card_id, reversed, description, None, deck, rotation, resolution))
 
-			# Flip 180 if reversed
-			if reversed:
-				image = image.rotate(180)
-
-			# Add card to list
-			cards.append(Card(card_id, reversed, description, image))
+		if load_images:
+			self.load_card_images(cards)
 
 		return cards
 
-	def load_image(self, deck, card_id):
-		"""Load PIL image for {card_id}.jpg from data/tarot/decks/{deck}"""
+	def load_card_images(self, cards):
+		"""Attach PIL image to each Card drawn without one"""
+		for card in cards:
+			if card.image is None:
+				card.image = self.load_image(card.deck, card.id, card.rotation, card.resolution)
+
+	def load_image(self, deck, card_id, rotation=0, resolution='full'):
+		"""Load PIL image for card_id in deck at a resolution tier, turned counterclockwise by rotation (0/90/180/270) degrees. Decodes/resizes/rotates only if not already cached."""
+		# Prefer a zero-copy view from the deck's atlas. Not cached: it takes no memory of its own.
+		if rotation == 0:
+			atlas = self.get_atlas(deck, resolution)
+			if atlas is not None:
+				return atlas.image(card_id)
+
+		key = (deck, card_id, rotation, resolution)
+		img = TarotService.image_cache.get(key)
+		if img is not None:
+			return img
+
+		# Build rotated variants from the upright image
+		if rotation != 0:
+			img = self.load_image(deck, card_id, 0, resolution).transpose(ROTATIONS[rotation])
+			TarotService.image_cache.put(key, img)
+			return img
+
 		# Won't work if ever in distribution. Convert to use pkg_resources?
 		this_directory, this_filename = os.path.split(__file__)
 		filename = str(card_id) + ".jpg"
-		img_filepath = os.path.join(this_directory, "data", "tarot", "decks", deck, filename)
+
+		# Full size is the source deck. Other tiers come from tools/build_resolutions.py,
+		# or are resized from full size here if they haven't been built.
+		if resolution == 'full':
+			img_filepath = os.path.join(this_directory, "data", "tarot", "decks", deck, filename)
+		else:
+			img_filepath = os.path.join(this_directory, "data", "tarot", "resolutions", resolution, deck, filename)
+
+			if not os.path.exists(img_filepath):
+				img = self.resize_card(self.load_image(deck, card_id), resolution)
+				TarotService.image_cache.put(key, img)
+				return img
 
 		# TODO raise error if invalid path. Only possible if self.decks and filesystem unsynchronized
 		img = Image.open(img_filepath, 'r')
 
+		# Decode now (open() is lazy) so the cache holds pixels, not an open file
+		img.load()
+		TarotService.image_cache.put(key, img)
+
 		return img
 
-	def load_data(self):
-		"""Load JSON from data/tarot/tarot.json into dict"""
-		# Won't work if ever in distribution. Convert to use pkg_resources?
-		this_directory, this_filename = os.path.split(__file__)
-		data_filepath = os.path.join(this_directory, "data", "tarot", "tarot.json")
+	@staticmethod
+	def resize_card(image, resolution):
+		"""Return copy of full-size card image scaled to resolution tier's width (keeping aspect ratio)"""
+		width = RESOLUTIONS[resolution]
+		if width is None or width >= image.width:
+			return image
 
-		with open(data_filepath, encoding='utf-8') as f:
-			data = json.load(f)
+		height = round(image.height * width / image.width)
+		return image.resize((width, height), Image.Resampling.LANCZOS)
 
-		return data
+	def get_atlas(self, deck, resolution='full'):
+		"""Return memory-mapped DeckAtlas from data/tarot/atlases/{deck}.atlas (or {deck}-{resolution}.atlas), or None if it hasn't been built"""
+		key = (deck, resolution)
+		with TarotService.atlases_lock:
+			if key not in TarotService.atlases:
+				this_directory, this_filename = os.path.split(__file__)
+				filename = deck + ("" if resolution == 'full' else "-" + resolution) + ".atlas"
+				atlas_filepath = os.path.join(this_directory, "data", "tarot", "atlases", filename)
+
+				atlas = DeckAtlas(atlas_filepath) if os.path.exists(atlas_filepath) else None
+				TarotService.atlases[key] = atlas
+
+			return TarotService.atlases[key]
 
-	def validate_arguments(self, deck, spread, definitions, reversals, pips):
-		"""Raise error if unsupported deck or spread, or non-boolean received for definitions, reversals, or pips."""
+	def prewarm(self, deck=DEFAULT_DECK, resolution='full'):
+		"""Decode every card in deck at resolution into the shared image cache (e.g. at startup)"""
+		for card_id in range(1, 79):
+			self.load_image(deck, card_id, 0, resolution)
+
+	def load_data(self):
+		"""Return read-only {id: CardData} index of data/tarot/tarot.json (shared, parsed once)"""
+		return TarotService.data_index.get()
+
+	def validate_arguments(self, deck, spread, definitions, reversals, pips, resolution):
+		"""Raise error if unsupported deck, spread or resolution, or non-boolean received for definitions, reversals, or pips."""
 		if deck not in self.decks:
 			raise DeckNotFoundError()
 
 		if spread not in self.spreads.keys():
 			raise SpreadNotFoundError()
 
+		# None means the spread's default resolution
+		if resolution is not None and resolution not in RESOLUTIONS:
+			raise ResolutionNotFoundError()
+
 		# Make sure all booleans are booleans
 		if not all(isinstance(b, bool) for b in [definitions, reversals, pips]):
 			raise BadTypeError()
 
 	# RUNNING
 
-	def response(self, deck='rider-waite-smith', spread='three-card', definitions=True, reversals=False, pips=True):
-		"""Build ResponseModel of message and generated PIL image for random cards based on arguments."""
+	def response(self, deck=DEFAULT_DECK, spread='three-card', definitions=True, reversals=False, pips=True, resolution=None, encoder=None):
+		"""Build ResponseModel of message and generated PIL image for random cards based on arguments. With an ImageEncoder, cached spreads come back already encoded when possible."""
 		try:
-			self.validate_arguments(deck, spread, definitions, reversals, pips)
+			self.validate_arguments(deck, spread, definitions, reversals, pips, resolution)
 		except DeckNotFoundError:
 			return ResponseModel('Deck not found. For a list of available decks, use `))help tarot`.')
 		except SpreadNotFoundError:
 			return ResponseModel('Spread not found. For a list of available spreads, use `))help tarot`.')
+		except ResolutionNotFoundError:
+			return ResponseModel('Resolution not found. For a list of available resolutions, use `))help tarot`.')
 		except BadTypeError:
 			return ResponseModel('Received an unexpected argument value. For formatting help, use `!help tarot`.')
 
 		# Get this spread's function (dict of functions defined in __init__)
 		spread_func = self.spreads[spread]
 
-		# Get list of randomized cards
-		cards = self.draw_cards(spread_func.card_count, deck, reversals, pips)
+		# Use spread's own resolution tier unless one was requested
+		if resolution is None:
+			resolution = spread_func.default_resolution
+
+		# Get list of randomized cards (images come later, since a cached render doesn't need them)
+		cards = self.draw_cards(spread_func.card_count, deck, reversals, pips, resolution, load_images=False)
+
+		# Identify image by everything that affects its pixels, if spread's encoded images are cached
+		render_key = None
+		image_bytes = None
+		if hasattr(spread_func, 'render_cached'):
+			render_key = (
+				deck,
+				spread,
+				resolution,
+				tuple(card.id for card in cards),
+				tuple(card.reversed for card in cards)
+			)
+
+			# Same cards, same encoder settings, same bytes
+			if encoder is not None:
+				image_bytes = TarotService.render_cache.get(render_key + encoder.settings())
+
+		# Only decode/resize/rotate cards if the image has to be built
+		if image_bytes is None:
+			self.load_card_images(cards)
 
 		# Send cards to spread function for ResponseModel of message and PIL image
 		result = spread_func(cards)
+		result.render_key = render_key
+		result.image_bytes = image_bytes
 
 		# Remove definitions if undesired
 		if not definitions:
 			result.message = ''
 
 		return result
+
+
+# RENDER JOBS
+# Module-level so a RenderExecutor can pickle and run them in worker processes
+
+def render(kwargs, encoder):
+	"""Build response from ))tarot arguments and encode its image with an ImageEncoder. Returns tuple of message and image bytes (or None)."""
+	result = TarotService().response(encoder=encoder, **kwargs)
+
+	# Render cache hits come back encoded. Otherwise encode, caching if the spread is cached.
+	image_bytes = result.image_bytes
+	if image_bytes is None and result.image is not None:
+		image_bytes = encoder.encode(result.image)
+		if result.render_key is not None:
+			TarotService.render_cache.put(result.render_key + encoder.settings(), image_bytes)
+
+	return result.message, image_bytes
+
+def cache_stats():
+	"""Return the calling process's cache counters"""
+	return {
+		'tarot image cache': TarotService.image_cache.stats(),
+		'tarot render cache': TarotService.render_cache.stats(),
+		'tarot data index': TarotService.data_index.stats()
+	}
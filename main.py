@@ -1,11 +1,15 @@
 import discord
 import os
 from app.handlers.messagehandler import MessageHandler
+from app.handlers.services import tarotservice, factservice
 
 class MyClient(discord.Client):
 	async def on_ready(self):
 		print('Pojo awakes')
 
+		# Load Pojo Facts in the background so the first ))fact doesn't wait on MySQL
+		factservice.FactService().start_background_loading()
+
 	async def on_message(self, message):
 		# If testing, ignore DMs and anything not from Testing Grounds server
 		if os.environ['ENVIRONMENT'] == 'testing' and (message.guild is None or message.guild.id != 413758117264883722):
@@ -27,8 +31,18 @@ intents.message_content = True
 client = MyClient(intents=intents)
 handler = MessageHandler(client)
 
-if 'BOT_TOKEN' in os.environ:
-	client.run(os.environ['BOT_TOKEN'])
-else:
-	print("ERROR: Client did not start. 'BOT_TOKEN' not found in environment variables.")
-	client.close()
\ No newline at end of file
+# Guarded so render worker processes can safely import this module
+if __name__ == '__main__':
+	# Optionally decode the default tarot deck up front so the first ))tarot is fast
+	# (forked render workers inherit the decoded images)
+	if os.environ.get('TAROT_PREWARM', '').lower() == 'true':
+		tarotservice.TarotService().prewarm()
+
+	# Start render workers while this is the only thread (forking later could deadlock on another thread's lock)
+	handler.render_executor.start()
+
+	if 'BOT_TOKEN' in os.environ:
+		client.run(os.environ['BOT_TOKEN'])
+	else:
+		print("ERROR: Client did not start. 'BOT_TOKEN' not found in environment variables.")
+		client.close()
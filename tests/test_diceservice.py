@@ -0,0 +1,30 @@
+import unittest
+
+from app.handlers.services import diceservice
+
+
+class StatsNeedsWorkerTest(unittest.TestCase):
+	"""Which `))dice stats` queries are sent to a worker instead of blocking the event loop"""
+	def test_big_keep_pools(self):
+		"""Keep/drop dice go to a worker by the cost of their DP, even with few possible totals"""
+		self.assertTrue(diceservice.stats_needs_worker('9d1000kh8'))
+		self.assertTrue(diceservice.stats_needs_worker('9d1000kh8 + 9d1000kh7'))
+		self.assertTrue(diceservice.stats_needs_worker('9d1000kh8 + 9d1000kh7 >= 9000'))
+
+	def test_many_outcomes(self):
+		"""Equations with many possible totals go to a worker"""
+		self.assertTrue(diceservice.stats_needs_worker('1000d100'))
+
+	def test_small_equations(self):
+		"""Cheap equations are worked out inline"""
+		self.assertFalse(diceservice.stats_needs_worker('4d6kh3 >= 15'))
+		self.assertFalse(diceservice.stats_needs_worker('2d20kl1'))
+		self.assertFalse(diceservice.stats_needs_worker('3d6+2'))
+
+	def test_malformed(self):
+		"""Malformed equations are answered inline with the parse error"""
+		self.assertFalse(diceservice.stats_needs_worker('3d'))
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,111 @@
+import os
+import unittest
+from collections import deque
+from unittest import mock
+
+try:
+	import fakeredis
+except ImportError:
+	fakeredis = None
+
+os.environ.setdefault('ENVIRONMENT', 'testing')
+
+from redis.exceptions import RedisError
+from app.handlers.services.factservice import FactService, DatabaseError
+from app.handlers.services.circuitbreaker import CircuitBreaker
+
+# More facts than the recent list holds, so there's always a fresh one to pick
+FACTS = [(i, 'Pojo fact #{}'.format(i)) for i in range(1, 61)]
+
+DATABASE_ERROR = "`Database error. Alert the admin and/or the president.`"
+
+
+@unittest.skipIf(fakeredis is None, 'needs fakeredis (and lupa, for its Lua scripts)')
+class FactServiceTest(unittest.IsolatedAsyncioTestCase):
+	"""FactService against FakeAsyncRedis as a local Redis stand-in, with MySQL replaced by query_facts()"""
+	def setUp(self):
+		# Fresh process-wide state for every test, restored afterwards
+		self.redis = fakeredis.FakeAsyncRedis(decode_responses=True)
+		self.patch(mock.patch.multiple(
+			FactService,
+			facts=None,
+			fact_ids=None,
+			last_id=0,
+			from_snapshot=False,
+			redis_conn=self.redis,
+			fact_script=None,
+			sync_script=None,
+			fresh_synced=False,
+			load_task=None,
+			refresh_task=None,
+			local_day=None,
+			local_counts={},
+			pending_counts={},
+			local_recent=deque(maxlen=FactService.RECENT_IDS_SIZE),
+			redis_breaker=CircuitBreaker((RedisError,), 2),
+			db_breaker=CircuitBreaker((DatabaseError,), 2)
+		))
+		self.patch(mock.patch.dict(os.environ, {'FACT_SNAPSHOT_PATH': 'off'}))
+		self.query_facts = self.patch(mock.patch.object(FactService, 'query_facts', return_value=FACTS))
+
+		self.service = FactService()
+		self.facts = dict(FACTS)
+
+	def patch(self, patcher):
+		"""Start patcher until the test ends, returning its mock"""
+		patched = patcher.start()
+		self.addCleanup(patcher.stop)
+		return patched
+
+	async def asyncTearDown(self):
+		await self.redis.aclose()
+
+	async def test_daily_limit(self):
+		"""Users get DAILY_MAX facts a day, then the limit message, without affecting other users"""
+		for i in range(FactService.DAILY_MAX):
+			self.assertIn(await self.service.response(1), self.facts.values())
+
+		self.assertEqual(await self.service.response(1), FactService.LIMIT_MESSAGE)
+		self.assertEqual(await self.service.response(1), FactService.LIMIT_MESSAGE)
+		self.assertIn(await self.service.response(2), self.facts.values())
+
+		# Counted in today's hash, which expires at midnight (once at the limit, users are answered without Redis)
+		quota_key = self.service.get_quota_key(self.service.get_next_midnight())
+		self.assertEqual(await self.redis.hget(quota_key, '1'), str(FactService.DAILY_MAX))
+		self.assertEqual(await self.redis.hget(quota_key, '2'), '1')
+		self.assertGreater(await self.redis.ttl(quota_key), 0)
+
+		# A process that hasn't seen the user yet is refused by Redis itself
+		FactService.local_counts.clear()
+		self.assertEqual(await self.service.response(1), FactService.LIMIT_MESSAGE)
+		self.assertEqual(await self.redis.hget(quota_key, '1'), str(FactService.DAILY_MAX + 1))
+
+	async def test_recent_facts_are_not_repeated(self):
+		"""No fact comes up again until RECENT_IDS_SIZE others have, across users"""
+		picked = []
+		for user_id in range(FactService.RECENT_IDS_SIZE + 1):
+			picked.append(await self.service.response(user_id))
+
+		self.assertEqual(len(set(picked)), len(picked))
+		self.assertEqual(await self.redis.llen('recentfacts'), FactService.RECENT_IDS_SIZE)
+		self.assertEqual(await self.redis.scard('freshfacts'), len(FACTS) - FactService.RECENT_IDS_SIZE)
+
+		# Oldest picks move back to the fresh set, newest stay out of it
+		fresh = await self.redis.smembers('freshfacts')
+		newest = [id_ for id_, message in FACTS if message == picked[-1]][0]
+		oldest = [id_ for id_, message in FACTS if message == picked[0]][0]
+		self.assertNotIn(str(newest), fresh)
+		self.assertIn(str(oldest), fresh)
+
+	async def test_database_error(self):
+		"""A failing database load answers with the database error, and a later request loads the facts again"""
+		self.query_facts.side_effect = DatabaseError()
+		self.assertEqual(await self.service.response(1), DATABASE_ERROR)
+		self.assertIsNone(FactService.facts)
+
+		self.query_facts.side_effect = None
+		self.assertIn(await self.service.response(1), self.facts.values())
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,139 @@
+"""Benchmark Redis memory and work for the daily fact quota: one hash per MST day vs a key per user.
+
+Usage: python tools/bench_fact_quota.py [users]
+
+Needs a live Redis at BENCH_REDIS_URL (default redis://localhost:6379/15). That database is
+FLUSHED before and after each run, so point it at a spare one. Every simulated user makes one
+request through each scheme:
+
+ • per-user keys: how FactService used to count, INCR + EXPIREAT NX + GET on `user:{id}`
+   (three round trips per request)
+ • day hash: FactService's quota step, HINCRBY on `facttries:{day}` (plus EXPIREAT the first
+   time a user shows up) in one script call
+
+Reports Redis memory growth and keys created once every user has been counted, commands Redis
+ran per request (from INFO commandstats, counting those run inside scripts), and round trips
+and time per request for a sample of unpipelined requests like the bot makes.
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import redis
+from app.handlers.services.factservice import FactService
+
+# The quota step of factservice.FACT_SCRIPT
+DAY_HASH_SCRIPT = """
+local count = redis.call('HINCRBY', KEYS[1], ARGV[2], 1)
+if count == 1 then
+	redis.call('EXPIREAT', KEYS[1], ARGV[1], 'NX')
+end
+return count
+"""
+
+# Requests sent per pipeline while filling Redis
+BATCH_SIZE = 1000
+
+# Unpipelined requests timed per scheme
+SAMPLE_SIZE = 2000
+
+
+class PerUserKeys:
+	"""The old scheme: a counter key with its own expiry per user"""
+	name = 'per-user keys'
+	round_trips = 3
+
+	def __init__(self, r, midnight):
+		self.midnight = midnight
+
+	def queue(self, pipe, user_id):
+		key = f"user:{user_id}"
+		pipe.incr(key)
+		pipe.expireat(key, self.midnight, nx=True)
+		pipe.get(key)
+
+	def request(self, r, user_id):
+		key = f"user:{user_id}"
+		r.incr(key)
+		r.expireat(key, self.midnight, nx=True)
+		return int(r.get(key))
+
+
+class DayHash:
+	"""The current scheme: a field per user in one hash per day"""
+	name = 'day hash'
+	round_trips = 1
+
+	def __init__(self, r, midnight):
+		self.midnight = midnight
+		self.key = FactService().get_quota_key(midnight)
+		self.script = r.register_script(DAY_HASH_SCRIPT)
+
+	def queue(self, pipe, user_id):
+		self.script(keys=[self.key], args=[int(self.midnight.timestamp()), user_id], client=pipe)
+
+	def request(self, r, user_id):
+		return int(self.script(keys=[self.key], args=[int(self.midnight.timestamp()), user_id]))
+
+
+def commands_run(r):
+	"""Return total commands Redis has run since stats were reset, leaving out the benchmark's own bookkeeping"""
+	stats = r.info('commandstats')
+	return sum(stat['calls'] for name, stat in stats.items() if name not in ('cmdstat_info', 'cmdstat_config|resetstat', 'cmdstat_config'))
+
+
+def run(r, scheme, users):
+	"""Count one request for each of users users, then time SAMPLE_SIZE more. Returns dict of results."""
+	r.flushdb()
+	r.config_resetstat()
+	memory_before = r.info('memory')['used_memory']
+
+	for start in range(0, users, BATCH_SIZE):
+		pipe = r.pipeline(transaction=False)
+		for user_id in range(start, min(start + BATCH_SIZE, users)):
+			scheme.queue(pipe, user_id)
+		pipe.execute()
+
+	results = {
+		'memory': r.info('memory')['used_memory'] - memory_before,
+		'keys': r.dbsize(),
+		'commands': commands_run(r) / users
+	}
+
+	# Second requests from a sample of the same users, one at a time
+	start = time.perf_counter()
+	for user_id in range(min(SAMPLE_SIZE, users)):
+		scheme.request(r, user_id)
+	results['seconds'] = (time.perf_counter() - start) / min(SAMPLE_SIZE, users)
+
+	r.flushdb()
+	return results
+
+
+def main():
+	users = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+	url = os.environ.get('BENCH_REDIS_URL', 'redis://localhost:6379/15')
+
+	r = redis.from_url(url, decode_responses=True)
+	midnight = FactService().get_next_midnight()
+
+	print(f'{users:,} users against {url}')
+	for scheme_type in (PerUserKeys, DayHash):
+		scheme = scheme_type(r, midnight)
+		results = run(r, scheme, users)
+
+		print('{:<14} {:>8.2f} MiB  {:>7.1f} bytes/user  {:>7,} keys  {:>4.1f} commands/request  {} round trips/request  {:>6.0f} µs/request'.format(
+			scheme.name,
+			results['memory'] / 1024 / 1024,
+			results['memory'] / users,
+			results['keys'],
+			results['commands'],
+			scheme.round_trips,
+			results['seconds'] * 1000000
+		))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,156 @@
+"""Microbenchmark I Ching responses: pre-rendered fragments joined once vs the old per-request path.
+
+Usage: python tools/bench_iching.py [responses]
+
+The old path is reproduced below: it rebuilds the trigram/hexagram dicts for every service
+instance and builds the message with += concatenation and format() calls on every response.
+Both render the same seeded castings, and their output is checked to be identical.
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from itertools import product
+from app.handlers.services.ichingservice import IChingService, Trigrams, Lines
+
+
+class OldIChingService(IChingService):
+	"""Response path from before fragments were pre-rendered (and castings were lists of Lines)"""
+	def __init__(self):
+		yin = True
+		yang = False
+		self.trigrams = {
+			(yang, yang, yang): Trigrams.HEAVEN,
+			(yang, yang, yin): Trigrams.LAKE,
+			(yang, yin, yang): Trigrams.FIRE,
+			(yang, yin, yin): Trigrams.THUNDER,
+			(yin, yang, yang): Trigrams.WIND,
+			(yin, yang, yin): Trigrams.WATER,
+			(yin, yin, yang): Trigrams.MOUNTAIN,
+			(yin, yin, yin): Trigrams.EARTH
+		}
+		self.hexagrams = dict(zip(product(Trigrams, repeat=2), list(IChingService.hexagrams.values())))
+
+	def get_trigrams(self, casting):
+		yin_bools = tuple([line.yin for line in casting])
+		return self.trigrams[yin_bools[:3]], self.trigrams[yin_bools[3:]]
+
+	def get_hexagram_id(self, bottom_trigram, top_trigram):
+		return self.hexagrams[(bottom_trigram, top_trigram)]
+
+	def get_relating_casting(self, casting):
+		casting = [Lines.YIN if line is Lines.OLDYANG else line for line in casting]
+		casting = [Lines.YANG if line is Lines.OLDYIN else line for line in casting]
+		return casting
+
+	def get_changing_line_numbers(self, casting):
+		return [i for i, line in enumerate(casting, start=1) if line in [Lines.OLDYIN, Lines.OLDYANG]]
+
+	def render_response(self, casting):
+		# Make initial casting
+		casting = self.get_lines(casting)
+		hexagram_id = self.get_hexagram_id(*self.get_trigrams(casting))
+
+		# Make relating casting
+		relating_casting = self.get_relating_casting(casting)
+		relating_hexagram_id = self.get_hexagram_id(*self.get_trigrams(relating_casting))
+
+		# Load full I Ching dictionary
+		data = self.load_data()
+
+		# Build response
+		response = ""
+
+		# Add title
+		response += '**HEXAGRAM {} — {}\n'.format(data[hexagram_id].id, data[hexagram_id].character)
+		response += data[hexagram_id].title + '**\n\n'
+
+		# Add hexagram (reversed to be top-down)
+		for line in casting[::-1]:
+			response += self.line_repr(line) + '\n'
+		response += '\n'
+
+		# Add Judgement
+		response += '**Judgement**\n'
+		response += '```{}```\n'.format(data[hexagram_id].judgement)
+
+		# Add Image
+		response += '**Image**\n'
+		response += '```{}```\n'.format(data[hexagram_id].image)
+
+		# Make link text (don't add yet)
+		link = 'For commentary and interpretation:\n'
+		link += 'http://www.akirarabelais.com/i/i.html#{}'.format(hexagram_id)
+
+		# Add changing lines and relating hexagram (if any changing lines)
+		changing_line_numbers = self.get_changing_line_numbers(casting)
+		if len(changing_line_numbers) > 0:
+			response += '**Changing Lines**\n'
+			number_list_str = ', '.join(str(num) for num in changing_line_numbers)
+			response += 'There are changing lines in lines: {} (numbered from the bottom)\n\n'.format(number_list_str)
+
+			for num in changing_line_numbers:
+				response += "Line {}:\n".format(num)
+				response += '```{}```\n'.format(data[hexagram_id].lines[num-1])
+
+			# Add commentary link
+			response += link + '\n\n'
+
+			# Add relating hexagram
+			response += '**RELATING HEXAGRAM: HEXAGRAM {} — {}\n'.format(data[relating_hexagram_id].id, data[relating_hexagram_id].character)
+			response += data[relating_hexagram_id].title + '**\n\n'
+
+			# Add hexagram (reversed to be top-down)
+			for line in relating_casting[::-1]:
+				response += self.line_repr(line) + '\n'
+			response += '\n'
+
+			# Add Judgement
+			response += '**Judgement**\n'
+			response += '```{}```\n'.format(data[relating_hexagram_id].judgement)
+
+			# Add Image
+			response += '**Image**\n'
+			response += '```{}```\n'.format(data[relating_hexagram_id].image)
+
+			# Add relating hexagram link
+			response += 'For commentary and interpretation:\n'
+			response += 'http://www.akirarabelais.com/i/i.html#{}'.format(relating_hexagram_id)
+		else:
+			# Add commentary link for sole hexagram (no changing lines)
+			response += link
+
+		return response
+
+def run(service_type, castings):
+	"""Return list of responses and seconds taken to render castings from new service instances (one per message, like MessageHandler)"""
+	start = time.perf_counter()
+	results = [service_type().render_response(casting) for casting in castings]
+	return results, time.perf_counter() - start
+
+
+def main():
+	responses = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+
+	# Warm up (first load of the shared index and fragments)
+	IChingService().response()
+
+	random.seed(0)
+	castings = [IChingService().cast() for _ in range(responses)]
+
+	old_results, old_seconds = run(OldIChingService, castings)
+	new_results, new_seconds = run(IChingService, castings)
+
+	if old_results != new_results:
+		print('WARNING: responses differ')
+
+	for name, seconds in [('old path', old_seconds), ('fragments', new_seconds)]:
+		print('{:<10} {:>8.1f} us/response'.format(name, seconds / responses * 1000000))
+	print('speedup    {:>8.1f}x'.format(old_seconds / new_seconds))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,85 @@
+"""Benchmark bitmap allocations per tarot reading: cached card rotations vs rotating on every draw.
+
+Usage: python tools/bench_rotation.py [readings]
+
+Runs the same seeded celtic-cross readings (with reversals) through TarotService as it is, and
+through a copy that rotates the upright card image on every draw like Pojo used to. Both start
+with a warm image cache so only per-reading work is measured.
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image
+from app.handlers.services.tarotservice import TarotService, ImageCache, RESOLUTIONS
+
+
+class RotateEveryDrawService(TarotService):
+	"""The old behavior: a fresh rotated bitmap every time a card is turned"""
+	def load_image(self, deck, card_id, rotation=0, resolution='full'):
+		image = super().load_image(deck, card_id, 0, resolution)
+		if rotation != 0:
+			image = image.rotate(rotation, expand=True)
+		return image
+
+
+class AllocationCounter:
+	"""Counts bitmaps Pillow creates (Image.new, rotate, transpose, ... all go through Image._new)"""
+	def __init__(self):
+		self.count = 0
+		self.bytes = 0
+		self.original = Image.Image._new
+
+	def __enter__(self):
+		counter = self
+
+		def counting_new(image, core):
+			result = counter.original(image, core)
+			counter.count += 1
+			counter.bytes += ImageCache.image_bytes(result)
+			return result
+
+		Image.Image._new = counting_new
+		return self
+
+	def __exit__(self, *exc):
+		Image.Image._new = self.original
+
+
+def run(service, readings):
+	"""Return allocation counter and seconds for readings celtic-cross spreads"""
+	random.seed(0)
+	start = time.perf_counter()
+	with AllocationCounter() as counter:
+		for _ in range(readings):
+			service.response(spread='celtic-cross', reversals=True)
+	return counter, time.perf_counter() - start
+
+
+def main():
+	readings = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+	# Room for every upright and rotated variant so eviction doesn't skew results
+	TarotService.image_cache = ImageCache(512 * 1024 * 1024)
+
+	# Decode from JPEGs even if atlases are built (atlas views would be counted as allocations)
+	TarotService.atlases = {(deck, resolution): None for deck in TarotService().decks for resolution in RESOLUTIONS}
+
+	for name, service in [('rotate every draw', RotateEveryDrawService()), ('cached rotations', TarotService())]:
+		# Warm up with the same readings so both runs start with all needed images cached
+		run(service, readings)
+		counter, seconds = run(service, readings)
+
+		print('{:<18} {:>7.1f} bitmaps/reading  {:>8.2f} MiB/reading  {:>6.2f} ms/reading'.format(
+			name,
+			counter.count / readings,
+			counter.bytes / readings / 1024 / 1024,
+			seconds / readings * 1000
+		))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,50 @@
+"""Pack tarot decks into memory-mapped atlas files for TarotService.
+
+Usage: python tools/build_atlas.py [deck ...]
+
+Decodes data/tarot/decks/{deck}/1.jpg through 78.jpg and writes data/tarot/atlases/{deck}.atlas
+(all decks if none named). TarotService uses an atlas automatically when one exists for a deck,
+so run this as a build step after changing deck images. Atlases hold raw pixels (~50 MB per deck)
+and aren't committed.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image
+from app.handlers.services import tarotservice
+from app.handlers.services.tarotservice import TarotService, DeckAtlas
+
+DATA_DIRECTORY = os.path.join(os.path.dirname(tarotservice.__file__), 'data', 'tarot')
+
+
+def build_deck(deck):
+	"""Decode deck's JPEGs and write its atlas, returning the atlas path"""
+	images = {}
+	for card_id in range(1, 79):
+		with Image.open(os.path.join(DATA_DIRECTORY, 'decks', deck, str(card_id) + '.jpg')) as image:
+			image.load()
+			images[card_id] = image
+
+	atlas_directory = os.path.join(DATA_DIRECTORY, 'atlases')
+	os.makedirs(atlas_directory, exist_ok=True)
+
+	# Write beside the final path and swap in, so running bots never map a half-written file
+	path = os.path.join(atlas_directory, deck + '.atlas')
+	DeckAtlas.build(images, path + '.tmp')
+	os.replace(path + '.tmp', path)
+
+	return path
+
+
+def main():
+	decks = sys.argv[1:] or TarotService().decks
+
+	for deck in decks:
+		path = build_deck(deck)
+		print('{}: {} ({:.1f} MiB)'.format(deck, path, os.path.getsize(path) / 1024 / 1024))
+
+
+if __name__ == '__main__':
+	main()
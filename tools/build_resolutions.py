@@ -0,0 +1,70 @@
+"""Pre-generate every tarot deck at each smaller resolution tier for TarotService.
+
+Usage: python tools/build_resolutions.py [--atlas] [deck ...]
+
+Resizes data/tarot/decks/{deck}/*.jpg to each tier in tarotservice.RESOLUTIONS and writes
+data/tarot/resolutions/{resolution}/{deck}/*.jpg (all decks if none named). With --atlas, also
+packs each tier into data/tarot/atlases/{deck}-{resolution}.atlas. TarotService resizes cards on
+the fly when a tier hasn't been built, so this only saves that work at runtime.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image
+from app.handlers.services import tarotservice
+from app.handlers.services.tarotservice import TarotService, DeckAtlas, RESOLUTIONS
+
+DATA_DIRECTORY = os.path.join(os.path.dirname(tarotservice.__file__), 'data', 'tarot')
+
+# Source decks are already JPEGs, so a high quality keeps re-compression artifacts out of smaller tiers
+JPEG_QUALITY = 92
+
+
+def build_deck(deck, atlas):
+	"""Write each smaller tier of deck (and its atlas if wanted), returning list of written directories/files"""
+	written = []
+
+	for resolution, width in RESOLUTIONS.items():
+		if width is None:
+			continue
+
+		directory = os.path.join(DATA_DIRECTORY, 'resolutions', resolution, deck)
+		os.makedirs(directory, exist_ok=True)
+
+		images = {}
+		for card_id in range(1, 79):
+			filename = str(card_id) + '.jpg'
+			with Image.open(os.path.join(DATA_DIRECTORY, 'decks', deck, filename)) as image:
+				image.load()
+				resized = TarotService.resize_card(image, resolution)
+
+			resized.save(os.path.join(directory, filename), 'JPEG', quality=JPEG_QUALITY)
+			images[card_id] = resized
+
+		written.append(directory)
+
+		if atlas:
+			# Built from the resized pixels directly so the atlas skips a JPEG round trip
+			path = os.path.join(DATA_DIRECTORY, 'atlases', deck + '-' + resolution + '.atlas')
+			os.makedirs(os.path.dirname(path), exist_ok=True)
+			DeckAtlas.build(images, path + '.tmp')
+			os.replace(path + '.tmp', path)
+			written.append(path)
+
+	return written
+
+
+def main():
+	arguments = sys.argv[1:]
+	atlas = '--atlas' in arguments
+	decks = [argument for argument in arguments if argument != '--atlas'] or TarotService().decks
+
+	for deck in decks:
+		for path in build_deck(deck, atlas):
+			print('{}: {}'.format(deck, path))
+
+
+if __name__ == '__main__':
+	main()